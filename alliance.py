@@ -0,0 +1,65 @@
+# Alliance points as a dense clan x event grid with running totals per clan
+# (row), per event (column) and overall, kept up to date on every change so
+# any cell, total or standing is a lookup rather than a walk over the table.
+# Clans and events get a row or column the first time they are seen.
+class AllianceMatrix:
+    def __init__(self, data=None):
+        self.clans = {}
+        self.events = {}
+        self.cells = []
+        self.clan_totals = []
+        self.event_totals = []
+        self.total = 0
+        for clan, events in (data or {}).items():
+            for event, points in events.items():
+                self.set(clan, event, points)
+
+    def _row(self, clan):
+        row = self.clans.get(clan)
+        if row is None:
+            row = self.clans[clan] = len(self.cells)
+            self.cells.append([0] * len(self.events))
+            self.clan_totals.append(0)
+        return row
+
+    def _column(self, event):
+        column = self.events.get(event)
+        if column is None:
+            column = self.events[event] = len(self.event_totals)
+            for row in self.cells:
+                row.append(0)
+            self.event_totals.append(0)
+        return column
+
+    def get(self, clan, event):
+        row = self.clans.get(clan)
+        column = self.events.get(event)
+        if row is None or column is None:
+            return 0
+        return self.cells[row][column]
+
+    def set(self, clan, event, points):
+        row = self._row(clan)
+        column = self._column(event)
+        delta = points - self.cells[row][column]
+        self.cells[row][column] = points
+        self.clan_totals[row] += delta
+        self.event_totals[column] += delta
+        self.total += delta
+
+    def clan_total(self, clan):
+        row = self.clans.get(clan)
+        return 0 if row is None else self.clan_totals[row]
+
+    def event_total(self, event):
+        column = self.events.get(event)
+        return 0 if column is None else self.event_totals[column]
+
+    # Clans as (clan, points), highest first: by total or within one event
+    def standings(self, event=None):
+        if event is None:
+            points = self.clan_totals
+        else:
+            column = self.events.get(event)
+            points = [0 if column is None else row[column] for row in self.cells]
+        return sorted(zip(self.clans, points), key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Discord allows 5 messages per 5 seconds in a channel and 50 requests per
+# second per bot
+CHANNEL_RATE = (5, 5.0)
+GLOBAL_RATE = (50, 1.0)
+MESSAGE_LIMIT = 2000
+
+
+# Sliding window limit of rate sends per per seconds, mirroring one of
+# Discord's rate limit buckets so sends wait here instead of on a 429
+class RateLimit:
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.sent = deque()
+
+    # Seconds until the next send is allowed
+    def delay(self):
+        now = time.monotonic()
+        while self.sent and self.sent[0] <= now - self.per:
+            self.sent.popleft()
+        return 0.0 if len(self.sent) < self.rate else self.sent[0] + self.per - now
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        self.sent.append(time.monotonic())
+
+
+# The first message of at most limit characters, one line per row, and the
+# lines left for the next one. A line too long for a message is cut.
+def take_message(lines, limit=MESSAGE_LIMIT):
+    if len(lines[0]) > limit:
+        return lines[0][:limit], [lines[0][limit:]] + lines[1:]
+    size = len(lines[0])
+    count = 1
+    while count < len(lines) and size + 1 + len(lines[count]) <= limit:
+        size += 1 + len(lines[count])
+        count += 1
+    return "\n".join(lines[:count]), lines[count:]
+
+
+# Public announcements of DKP changes, collected per channel over a short
+# window and sent as one message, so a burst of commands at the end of a
+# raid costs a few channel messages instead of one each. Sends go through a
+# per-channel and a global rate limit and run in the background: post()
+# returns at once, and the command that posted never waits on Discord.
+# Lines posted while a channel waits for its rate limit join its next message.
+class AnnouncementQueue:
+    def __init__(self, window, channel_rate=CHANNEL_RATE, global_rate=GLOBAL_RATE):
+        self.window = window
+        self.channel_rate = channel_rate
+        self.global_limit = RateLimit(*global_rate)
+        self.limits = {}
+        self.channels = {}
+        self.pending = {}
+        self.tasks = {}
+
+    def post(self, channel, text):
+        self.channels[channel.id] = channel
+        self.pending.setdefault(channel.id, []).append(text)
+        metrics.inc("dkp_announcement_lines_total")
+        task = self.tasks.get(channel.id)
+        if task is None or task.done():
+            self.tasks[channel.id] = asyncio.ensure_future(self._drain(channel.id))
+
+    async def _drain(self, channel_id):
+        while self.pending.get(channel_id):
+            await asyncio.sleep(self.window)
+            try:
+                await self._send(channel_id)
+            except Exception:
+                logger.exception(f"Failed to send announcements to channel {channel_id}")
+
+    # Sends to a channel are serialized, so a flush waits for a send in
+    # progress and its messages keep their order
+    async def _send(self, channel_id):
+        if channel_id not in self.limits:
+            self.limits[channel_id] = (RateLimit(*self.channel_rate), asyncio.Lock())
+        limit, lock = self.limits[channel_id]
+        async with lock:
+            while self.pending.get(channel_id):
+                await limit.acquire()
+                await self.global_limit.acquire()
+                # Whatever does not fit in one message waits for the next send
+                message, rest = take_message(self.pending.pop(channel_id))
+                if rest:
+                    self.pending[channel_id] = rest
+                await self.channels[channel_id].send(message)
+                metrics.inc("dkp_announcement_messages_total")
+
+    # Send everything still queued, without waiting for the window
+    async def flush(self):
+        for channel_id in list(self.pending):
+            try:
+                await self._send(channel_id)
+            except Exception:
+                logger.exception(f"Failed to send announcements to channel {channel_id}")
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Discord shows at most 25 autocomplete choices
+MAX_CHOICES = 25
+CACHE_SIZE = 1024
+
+
+def normalize(text):
+    return " ".join(text.casefold().split())
+
+def _word_starts(key):
+    return [start for start in range(1, len(key)) if not key[start - 1].isalnum() and key[start].isalnum()]
+
+
+# Autocomplete over a fixed list of (label, value) entries. Labels are
+# normalized once into sorted tables of (key, entry) pairs, so a query is a
+# bisection plus a walk over at most MAX_CHOICES matches however long the
+# list is. Matches on the start of the label rank first, then matches on
+# the start of a later word, then (with substrings=True) matches anywhere
+# in the label; each group is in alphabetical order. An empty query lists
+# the entries in their original order. Results are cached per query.
+class SearchIndex:
+    def __init__(self, entries, substrings=False):
+        self.entries = list(entries)
+        labels = []
+        words = []
+        inner = []
+        for idx, (label, _) in enumerate(self.entries):
+            key = normalize(label)
+            labels.append((key, idx))
+            starts = _word_starts(key)
+            words.extend((key[start:], idx) for start in starts)
+            if substrings:
+                inner.extend((key[start:], idx) for start in range(1, len(key)) if start not in starts)
+        self.tables = [sorted(table) for table in (labels, words, inner) if table]
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Up to MAX_CHOICES (label, value) entries matching the query, best first
+    def search(self, query):
+        key = normalize(query)
+        found = self.cache.get(key)
+        if found is not None:
+            self.cache.move_to_end(key)
+            return found
+
+        if not key:
+            found = self.entries[:MAX_CHOICES]
+        else:
+            matched = []
+            seen = set()
+            for table in self.tables:
+                position = bisect_left(table, (key,))
+                while position < len(table) and len(matched) < MAX_CHOICES and table[position][0].startswith(key):
+                    idx = table[position][1]
+                    if idx not in seen:
+                        seen.add(idx)
+                        matched.append(idx)
+                    position += 1
+            found = [self.entries[idx] for idx in matched]
+
+        self.cache[key] = found
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return found
+
+
+# Autocomplete over a guild's archived members, labelled with their name
+# while they are still in the guild and always searchable by ID. The index
+# is built on first use and rebuilt in the background whenever the store's
+# archive_version shows members were archived or restored since; until the
+# new index is ready the old one keeps answering.
+class ArchiveSearch:
+    def __init__(self, store):
+        self.store = store
+        self.index = None
+        self.version = None
+        self.task = None
+
+    async def search(self, guild, query):
+        if self.index is None:
+            await self.refresh(guild)
+        elif self.version != self.store.archive_version and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._rebuild(guild))
+        return self.index.search(query)
+
+    async def _rebuild(self, guild):
+        try:
+            await self.refresh(guild)
+        except Exception:
+            self.version = None
+            logger.exception("Failed to index archived members for autocomplete")
+
+    async def refresh(self, guild):
+        self.version = self.store.archive_version
+        entries = []
+        for member_id, balance in await self.store.archived_members():
+            member = guild.get_member(int(member_id)) if guild is not None else None
+            label = f"{member_id} - {balance} DKP" if member is None else f"{member.display_name} ({member_id}) - {balance} DKP"
+            # Choice names are limited to 100 characters
+            entries.append((label[:100], member_id))
+        # Sorting the keys of a large archive takes a while; keep the event loop free meanwhile
+        self.index = await asyncio.get_running_loop().run_in_executor(None, SearchIndex, entries)
+        logger.debug(f"Indexed {len(entries)} archived member(s) for autocomplete.")
@@ -0,0 +1,190 @@
+"""Offline benchmark for the DKPManager command callbacks.
+
+Runs each command against stand-in Discord objects and a synthetic guild, with
+no network access. Every roster size runs in its own process and data
+directory so results are independent and repeatable:
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --sizes 100,10000 --months 24 --backend sqlite
+    python benchmarks/bench.py --format compact
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+
+def percentile(latencies, q):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def measure(count, call):
+    latencies = []
+    started = time.perf_counter()
+    for idx in range(count):
+        call_started = time.perf_counter()
+        await call(idx)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": count,
+        "seconds": elapsed,
+        "ops_per_second": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run_scenarios(bot, guild, admin, ops, seed):
+    rng = random.Random(seed)
+    members = [member for member in guild.members if member is not admin]
+    cog = bot.DKPManager(bot.bot)
+    bot.bot.get_guild = lambda guild_id: guild
+    context = bot.guild_contexts[guild.id]
+    store = context.store
+    # Finish the startup rollover before timing anything
+    cog.month_rollover.cancel()
+    cog.apply_decay.cancel()
+    await store.rollover(bot.LEADERBOARD_HOT_MONTHS)
+    results = {}
+
+    async def dkp_add(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_add.callback(cog, interaction, rng.choice(members), rng.randint(1, 50))
+    results["dkp_add"] = await measure(ops, dkp_add)
+
+    async def dkp_trade(idx):
+        sender, receiver = rng.sample(members, 2)
+        interaction = fakes.FakeInteraction(sender, guild, fakes.TRANSFER_CHANNEL_ID)
+        await bot.DKPManager.dkp_trade.callback(cog, interaction, receiver, rng.randint(1, 10))
+    results["dkp_trade"] = await measure(ops, dkp_trade)
+
+    async def dkp_leaderboard(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_leaderboard.callback(cog, interaction, rng.choice(["overall", "current", "last", "last 6"]))
+    results["dkp_leaderboard"] = await measure(ops, dkp_leaderboard)
+
+    async def dkp_alliance_add(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.ALLIANCE_ADDREMOVE_CHANNEL_ID)
+        await bot.DKPManager.dkp_alliance_add.callback(
+            cog, interaction, rng.choice(fakes.EVENTS), rng.choice(fakes.CLANS), rng.randint(1, 50)
+        )
+    results["dkp_alliance_add"] = await measure(ops, dkp_alliance_add)
+
+    async def dkp_alliance_board(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.ALLIANCE_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_alliance_board.callback(cog, interaction, rng.choice([None] + fakes.EVENTS))
+    results["dkp_alliance_board"] = await measure(ops, dkp_alliance_board)
+
+    # Keystrokes in the archived member autocomplete, over a warm index
+    prefixes = [str(fakes.FIRST_MEMBER_ID)[:length] for length in range(1, 8)] + ["", "1", "9"]
+    async def archive_autocomplete(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await cog.archive_autocomplete(interaction, prefixes[idx % len(prefixes)] + str(idx % 7))
+    results["archive_autocomplete"] = await measure(ops, archive_autocomplete)
+
+    # A burst of members dropping or gaining the member role
+    toggled = rng.sample(members, min(len(members), ops))
+    async def on_member_update(idx):
+        member = toggled[idx % len(toggled)]
+        before = copy.copy(member)
+        if guild.member_role in member.roles:
+            member.roles = [role for role in member.roles if role != guild.member_role]
+        else:
+            member.roles = member.roles + [guild.member_role]
+        await bot.on_member_update(before, member)
+    results["on_member_update"] = await measure(ops, on_member_update)
+
+    # Apply the role changes queued above as one batch
+    async def role_change_flush(idx):
+        await context.role_changes.flush()
+    results["role_change_flush"] = await measure(1, role_change_flush)
+
+    async def dkp_decay_preview(idx):
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_decay_preview.callback(cog, interaction, 10.0, 50)
+    results["dkp_decay_preview"] = await measure(max(3, ops // 100), dkp_decay_preview)
+
+    async def initialize_leaderboard(idx):
+        await bot.initialize_leaderboard(context)
+    results["initialize_leaderboard"] = await measure(max(3, ops // 100), initialize_leaderboard)
+
+    if isinstance(store, bot.JsonStore):
+        # Rewrite every snapshot file, as a compaction after a busy day would
+        async def compact_snapshots(idx):
+            store.dirty.update(store.files)
+            await store.compact()
+        results["compact_snapshots"] = await measure(3, compact_snapshots)
+
+    cog.flush_data.cancel()
+    await store.flush()
+    return results
+
+
+def run_single(args):
+    # Pre-import discord so the startup timing covers the bot's own setup
+    import discord  # noqa: F401
+
+    with tempfile.TemporaryDirectory(prefix="dkp-bench-") as data_dir:
+        guild, admin = fakes.build_dataset(data_dir, args.members, args.months, seed=args.seed, data_format=args.format)
+        started = time.perf_counter()
+        bot = fakes.import_bot(data_dir, DATA_BACKEND=args.backend, DATA_FORMAT=args.format, DATA_FLUSH_INTERVAL=3600)
+        startup = time.perf_counter() - started
+
+        results = asyncio.run(run_scenarios(bot, guild, admin, args.ops, args.seed))
+        for context in bot.guild_contexts.values():
+            context.store.close()
+        data_bytes = sum(
+            os.path.getsize(os.path.join(directory, file)) for directory, _, files in os.walk(data_dir) for file in files
+        )
+
+    print(json.dumps({"members": args.members, "startup_seconds": startup, "data_bytes": data_bytes, "results": results}))
+
+
+def run_all(args):
+    print(f"backend={args.backend} format={args.format} months={args.months} ops={args.ops} seed={args.seed}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        output = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), "--members", str(size),
+                "--months", str(args.months), "--ops", str(args.ops),
+                "--backend", args.backend, "--format", args.format, "--seed", str(args.seed),
+            ],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+
+        print(f"\n{size} members (startup {report['startup_seconds']:.2f}s, data files {report['data_bytes'] / 1e6:.1f} MB)")
+        print(f"{'scenario':<24}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, result in report["results"].items():
+            print(f"{name:<24}{result['ops']:>8}{result['ops_per_second']:>12.1f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,10000,100000", help="comma-separated roster sizes")
+    parser.add_argument("--members", type=int, help="run a single roster size in this process")
+    parser.add_argument("--months", type=int, default=12, help="months of earnings history per member")
+    parser.add_argument("--ops", type=int, default=1000, help="calls per scenario")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--format", default="json", choices=["json", "compact"], help="snapshot file format for the json backend")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.members is None:
+        run_all(args)
+    else:
+        run_single(args)
+
+
+if __name__ == "__main__":
+    main()
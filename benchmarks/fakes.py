@@ -0,0 +1,191 @@
+import asyncio
+import os
+import random
+import sys
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import dataformat  # noqa: E402
+
+GUILD_ID = 900000000000000001
+DKP_SHOW_CHANNEL_ID = 900000000000000010
+ALLIANCE_ADDREMOVE_CHANNEL_ID = 900000000000000011
+ALLIANCE_SHOW_CHANNEL_ID = 900000000000000012
+TRANSFER_CHANNEL_ID = 900000000000000013
+MEMBER_ROLE = "Member"
+OFFICER_ROLE = "Officer"
+ALLIANCE_LEADER_ROLE = "Alliance Leader"
+CLANS = [f"Clan{idx}" for idx in range(8)]
+EVENTS = [f"Event{idx}" for idx in range(6)]
+FIRST_MEMBER_ID = 100000000000000000
+
+
+# Environment the bot module reads at import time
+def bot_environment():
+    return {
+        "GUILD_ID": str(GUILD_ID),
+        "ALLOWED_DKP_SHOW_CHANNEL_ID": str(DKP_SHOW_CHANNEL_ID),
+        "ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID": str(ALLIANCE_ADDREMOVE_CHANNEL_ID),
+        "ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID": str(ALLIANCE_SHOW_CHANNEL_ID),
+        "TRANSFER_CHANNEL_ID": str(TRANSFER_CHANNEL_ID),
+        "DISCORD_TOKEN": "benchmark",
+        "MEMBER_ROLE": MEMBER_ROLE,
+        "OFFICER_ROLE": OFFICER_ROLE,
+        "ALLIANCE_LEADER_ROLE": ALLIANCE_LEADER_ROLE,
+        "ALLOWED_CLANS": ",".join(CLANS),
+        "ALLOWED_EVENTS_LIST": ",".join(EVENTS),
+        "LOG_LEVEL": "WARNING",
+    }
+
+# Import bot.py from a data directory without connecting to Discord. The
+# module opens its store from the current directory, so chdir first.
+def import_bot(data_dir, **settings):
+    os.environ.update(bot_environment())
+    os.environ.update({name: str(value) for name, value in settings.items()})
+    os.chdir(data_dir)
+    import bot
+    return bot
+
+
+# Stand-ins for the discord.py objects the command callbacks touch
+class FakeRole:
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+        self.members = []
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+        self.manage_guild = administrator
+
+
+class FakeMember:
+    def __init__(self, member_id, roles, guild=None, administrator=False):
+        self.id = member_id
+        self.name = f"member{member_id - FIRST_MEMBER_ID}"
+        self.mention = f"<@{member_id}>"
+        self.roles = list(roles)
+        self.guild = guild
+        self.guild_permissions = FakePermissions(administrator)
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+
+class FakeGuild:
+    def __init__(self, guild_id=GUILD_ID):
+        self.id = guild_id
+        self.member_role = FakeRole(1, MEMBER_ROLE)
+        self.officer_role = FakeRole(2, OFFICER_ROLE)
+        self.alliance_leader_role = FakeRole(3, ALLIANCE_LEADER_ROLE)
+        self.roles = [self.member_role, self.officer_role, self.alliance_leader_role]
+        self.members = []
+        self._members = {}
+
+    def add_member(self, member):
+        member.guild = self
+        self.members.append(member)
+        self._members[member.id] = member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.parent_id = None
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        self.messages.append(content)
+
+
+# Responses yield to the event loop like the real HTTP calls do, so
+# concurrent interactions interleave at the same points they would live
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(0)
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+    async def send_message(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        self.done = True
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        self.messages.append(content)
+
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel_id):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = FakeChannel(channel_id)
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+# Synthetic guild data: members with balances, months of earnings history,
+# an archive of departed members and a filled alliance table. Written as the
+# bot's data files into data_dir. Returns the guild with its members.
+def build_dataset(data_dir, members, months, archived=None, seed=0, data_format=dataformat.JSON):
+    rng = random.Random(seed)
+    archived = members // 10 if archived is None else archived
+    now = datetime.now()
+    month_keys = [(now - relativedelta(months=offset)).strftime("%Y-%m") for offset in range(months)]
+
+    guild = FakeGuild()
+    admin = FakeMember(FIRST_MEMBER_ID - 1, [guild.officer_role, guild.alliance_leader_role], administrator=True)
+    guild.add_member(admin)
+
+    dkp_data = {}
+    leaderboard_data = {}
+    for idx in range(members):
+        member = FakeMember(FIRST_MEMBER_ID + idx, [guild.member_role])
+        guild.add_member(member)
+        guild.member_role.members.append(member)
+        member_id = str(member.id)
+        history = {month: rng.randint(0, 200) for month in month_keys if rng.random() < 0.7}
+        leaderboard_data[member_id] = history
+        dkp_data[member_id] = sum(history.values())
+
+    archive_data = {str(FIRST_MEMBER_ID + members + idx): rng.randint(0, 500) for idx in range(archived)}
+    alliance_data = {clan: {event: rng.randint(0, 1000) for event in EVENTS} for clan in CLANS}
+
+    for file, data in (
+        ("dkp_data.json", dkp_data),
+        ("leaderboard_data.json", leaderboard_data),
+        ("dkp_archive.json", archive_data),
+        ("alliance_dkp_data.json", alliance_data),
+    ):
+        with open(os.path.join(data_dir, file), "wb") as f:
+            f.write(dataformat.dumps(data, data_format))
+
+    return guild, admin
@@ -0,0 +1,191 @@
+"""Concurrent load test for the DKPManager command callbacks.
+
+Keeps many interleaved dkp_add, dkp_cancel and dkp_trade interactions in
+flight at once against a synthetic guild in a temporary data directory, then
+checks that no update was lost:
+
+* trades move DKP between members without changing the total,
+* every member's balance and current-month total match the adds, cancels and
+  trades that reported success,
+* the data reloaded from disk matches what the bot held in memory.
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --members 5000 --ops 50000 --concurrency 500 --backend sqlite
+
+Exits with status 1 when an invariant does not hold.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import fakes
+from bench import percentile
+
+
+# Sample how late the event loop wakes up from short sleeps. A sleep still
+# pending when the monitor is cancelled counts too, so a loop that never
+# yields shows up as one long stall instead of no samples.
+async def monitor_loop_lag(lags, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        try:
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            overdue = time.perf_counter() - started - interval
+            if overdue > 0:
+                lags.append(overdue)
+            raise
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run_load(bot, guild, admin, args):
+    rng = random.Random(args.seed)
+    members = [member for member in guild.members if member is not admin]
+    member_ids = [str(member.id) for member in members]
+    cog = bot.DKPManager(bot.bot)
+    store = bot.guild_contexts[guild.id].store
+    month = bot.datetime.now().strftime("%Y-%m")
+
+    balances_before = {member_id: await store.balance(member_id) for member_id in member_ids}
+    months_before = {member_id: await store.month_total(member_id, month) for member_id in member_ids}
+
+    balance_delta = Counter()
+    month_delta = Counter()
+    latencies = defaultdict(list)
+    outcomes = Counter()
+    remaining = [args.ops]
+
+    async def add():
+        member = rng.choice(members)
+        amount = rng.randint(1, 50)
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_add.callback(cog, interaction, member, amount)
+        if interaction.followup.messages[-1].startswith("Added"):
+            balance_delta[str(member.id)] += amount
+            month_delta[str(member.id)] += amount
+            return True
+        return False
+
+    async def cancel():
+        member = rng.choice(members)
+        amount = rng.randint(1, 30)
+        interaction = fakes.FakeInteraction(admin, guild, fakes.DKP_SHOW_CHANNEL_ID)
+        await bot.DKPManager.dkp_cancel.callback(cog, interaction, member, amount)
+        if interaction.followup.messages[-1].startswith("Canceled"):
+            balance_delta[str(member.id)] -= amount
+            month_delta[str(member.id)] -= amount
+            return True
+        return False
+
+    async def trade():
+        sender, receiver = rng.sample(members, 2)
+        amount = rng.randint(1, 20)
+        interaction = fakes.FakeInteraction(sender, guild, fakes.TRANSFER_CHANNEL_ID)
+        await bot.DKPManager.dkp_trade.callback(cog, interaction, receiver, amount)
+        if "DKP до" in interaction.followup.messages[-1]:
+            balance_delta[str(sender.id)] -= amount
+            balance_delta[str(receiver.id)] += amount
+            return True
+        return False
+
+    operations = [(add, 5), (cancel, 2), (trade, 3)]
+    kinds = [operation for operation, weight in operations for _ in range(weight)]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            operation = rng.choice(kinds)
+            started = time.perf_counter()
+            applied = await operation()
+            latencies[operation.__name__].append(time.perf_counter() - started)
+            outcomes[(operation.__name__, "applied" if applied else "rejected")] += 1
+
+    lags = []
+    monitor = asyncio.ensure_future(monitor_loop_lag(lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+    cog.flush_data.cancel()
+    cog.month_rollover.cancel()
+    cog.apply_decay.cancel()
+    await store.flush()
+
+    print(f"{args.ops} operations with {args.concurrency} in flight: {elapsed:.2f}s, {args.ops / elapsed:.1f} ops/s")
+    print(f"{'operation':<12}{'applied':>10}{'rejected':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(latencies.items()):
+        print(
+            f"{name:<12}{outcomes[(name, 'applied')]:>10}{outcomes[(name, 'rejected')]:>10}"
+            f"{percentile(values, 0.5) * 1000:>10.3f}{percentile(values, 0.99) * 1000:>10.3f}"
+        )
+    if lags:
+        print(f"event loop lag: p50 {percentile(lags, 0.5) * 1000:.3f} ms, p99 {percentile(lags, 0.99) * 1000:.3f} ms, max {max(lags) * 1000:.3f} ms")
+
+    # Invariants
+    failures = []
+    balances_after = {member_id: await store.balance(member_id) for member_id in member_ids}
+    months_after = {member_id: await store.month_total(member_id, month) for member_id in member_ids}
+
+    expected_total = sum(balances_before.values()) + sum(month_delta.values())
+    if sum(balances_after.values()) != expected_total:
+        failures.append(f"total DKP is {sum(balances_after.values())}, expected {expected_total}")
+
+    lost_balances = [m for m in member_ids if balances_after[m] != balances_before[m] + balance_delta[m]]
+    if lost_balances:
+        failures.append(f"{len(lost_balances)} member balance(s) do not match the applied operations")
+
+    lost_months = [m for m in member_ids if months_after[m] != months_before[m] + month_delta[m]]
+    if lost_months:
+        failures.append(f"{len(lost_months)} monthly total(s) do not match the applied adds and cancels")
+
+    negative = [m for m in member_ids if balances_after[m] < 0]
+    if negative:
+        failures.append(f"{len(negative)} member(s) ended with negative DKP")
+
+    return failures, balances_after, months_after, month
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=1000, help="roster size")
+    parser.add_argument("--months", type=int, default=6, help="months of earnings history per member")
+    parser.add_argument("--ops", type=int, default=20000, help="total interactions to run")
+    parser.add_argument("--concurrency", type=int, default=200, help="interactions in flight at once")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="dkp-load-") as data_dir:
+        guild, admin = fakes.build_dataset(data_dir, args.members, args.months, seed=args.seed)
+        # A small compaction threshold makes snapshot rewrites happen under load
+        bot = fakes.import_bot(data_dir, DATA_BACKEND=args.backend, DATA_FLUSH_INTERVAL=0.05, DATA_COMPACT_THRESHOLD=500)
+
+        failures, balances, months, month = asyncio.run(run_load(bot, guild, admin, args))
+        context = bot.guild_contexts[guild.id]
+        context.store.close()
+
+        # Everything acknowledged must survive a restart
+        reloaded = bot.open_store(context.config)
+        async def read_back():
+            return (
+                {member_id: await reloaded.balance(member_id) for member_id in balances},
+                {member_id: await reloaded.month_total(member_id, month) for member_id in months},
+            )
+        reloaded_balances, reloaded_months = asyncio.run(read_back())
+        reloaded.close()
+        if reloaded_balances != balances or reloaded_months != months:
+            failures.append("data reloaded from disk differs from the in-memory state")
+
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+    print("OK: balances, monthly totals and persisted data are consistent")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,36 +4,44 @@ from discord.ui import View, Select, Button, TextInput, Modal
 from discord import app_commands
 import logging
 import os
+import csv
+import functools
+import hashlib
+import heapq
+import io
 import json
+import re
+import signal
+import time
 from datetime import datetime, timedelta
 import asyncio
 from dateutil.relativedelta import relativedelta
+from storage import JsonStore, InsufficientDKP, load_data, save_data, DKP, LEADERBOARD, ARCHIVE, ALLIANCE, META
+from sqlite_storage import SqliteStore, migrate_json_to_sqlite
+from pagination import PageView
+from metrics import metrics, instrument_command
+from roles import MEMBER, OFFICER, ALLIANCE_LEADER
+from guilds import GuildContext, load_guild_configs
+from announcements import AnnouncementQueue
 
 # Load environment variables
-try:
-    GUILD_ID = int(os.getenv("GUILD_ID"))
-except (TypeError, ValueError):
-    raise ValueError("GUILD_ID environment variable is not set or invalid. Please check the .env file.")
-
-try:
-    ALLOWED_DKP_SHOW_CHANNEL_ID = int(os.getenv("ALLOWED_DKP_SHOW_CHANNEL_ID"))
-except (TypeError, ValueError):
-    raise ValueError("ALLOWED_DKP_SHOW_CHANNEL_ID environment variable is not set or invalid. Please check the .env file.")
-
-try:
-    ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID = int(os.getenv("ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID"))
-except (TypeError, ValueError):
-    raise ValueError("ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID environment variable is not set or invalid. Please check the .env file.")
-
-try:
-    ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID = int(os.getenv("ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID"))
-except (TypeError, ValueError):
-    raise ValueError("ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID environment variable is not set or invalid. Please check the .env file.")
-
-try:
-    TRANSFER_CHANNEL_ID = int(os.getenv("TRANSFER_CHANNEL_ID"))
-except (TypeError, ValueError):
-    raise ValueError("TRANSFER_CHANNEL_ID environment variable is not set or invalid. Please check the .env file.")
+GUILDS_CONFIG = os.getenv("GUILDS_CONFIG")  # JSON file with per-guild settings, see the README
+
+# Guild and channel IDs are required unless GUILDS_CONFIG sets them per guild
+def id_setting(name):
+    value = os.getenv(name)
+    if value is None and GUILDS_CONFIG:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} environment variable is not set or invalid. Please check the .env file.")
+
+GUILD_ID = id_setting("GUILD_ID")
+ALLOWED_DKP_SHOW_CHANNEL_ID = id_setting("ALLOWED_DKP_SHOW_CHANNEL_ID")
+ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID = id_setting("ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID")
+ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID = id_setting("ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID")
+TRANSFER_CHANNEL_ID = id_setting("TRANSFER_CHANNEL_ID")
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -42,140 +50,433 @@ OFFICER_ROLE = os.getenv("OFFICER_ROLE")
 ALLOWED_CLANS = os.getenv("ALLOWED_CLANS", "").split(",")  # Comma-separated list
 ALLOWED_EVENTS_LIST = os.getenv("ALLOWED_EVENTS_LIST", "").split(",")  # Comma-separated list
 ALLIANCE_LEADER_ROLE = os.getenv("ALLIANCE_LEADER_ROLE")
+DATA_FLUSH_INTERVAL = float(os.getenv("DATA_FLUSH_INTERVAL", "30"))  # Seconds between background flushes
+DATA_COMPACT_THRESHOLD = int(os.getenv("DATA_COMPACT_THRESHOLD", "1000"))  # Ledger records before snapshots are rewritten
+DATA_BACKEND = os.getenv("DATA_BACKEND", "json").lower()  # "json" or "sqlite"
+DATA_FORMAT = os.getenv("DATA_FORMAT", "json").lower()  # Snapshot file format for the json backend: "json" or "compact"
+LEADERBOARD_PAGE_SIZE = int(os.getenv("LEADERBOARD_PAGE_SIZE", "20"))  # Rows per leaderboard/archive page
+LEADERBOARD_HOT_MONTHS = int(os.getenv("LEADERBOARD_HOT_MONTHS", "3"))  # Months kept in memory, older ones move to the history files
+DKP_DECAY_PERCENT = float(os.getenv("DKP_DECAY_PERCENT", "0"))  # Percent of each balance removed per period, 0 disables decay
+DKP_DECAY_FLOOR = int(os.getenv("DKP_DECAY_FLOOR", "0"))  # Decay never takes a balance below this
+DKP_DECAY_SCHEDULE = os.getenv("DKP_DECAY_SCHEDULE", "monthly").lower()  # "weekly" or "monthly"
+if DKP_DECAY_SCHEDULE not in ("weekly", "monthly"):
+    raise ValueError("DKP_DECAY_SCHEDULE must be 'weekly' or 'monthly'. Please check the .env file.")
+ROLE_UPDATE_WINDOW = float(os.getenv("ROLE_UPDATE_WINDOW", "2"))  # Seconds member role changes are collected before being applied together
+ANNOUNCE_WINDOW = float(os.getenv("ANNOUNCE_WINDOW", "2"))  # Seconds DKP change announcements are collected per channel before being sent together
+EXPORT_FILE_BYTES = int(os.getenv("EXPORT_FILE_BYTES", str(8 * 1024 * 1024)))  # Approximate size of each CSV file sent by /dkp_export
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Serve Prometheus metrics on 127.0.0.1 when set
+METRICS_FILE = os.getenv("METRICS_FILE")  # Also write metrics to this file on every flush when set
 
 # Configure logging
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# Per-guild settings, with the environment as the defaults
+GUILD_CONFIGS = load_guild_configs(GUILDS_CONFIG, {
+    "guild_id": GUILD_ID,
+    "dkp_channel_id": ALLOWED_DKP_SHOW_CHANNEL_ID,
+    "alliance_addremove_channel_id": ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID,
+    "alliance_show_channel_id": ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID,
+    "transfer_channel_id": TRANSFER_CHANNEL_ID,
+    "member_role": MEMBER_ROLE,
+    "officer_role": OFFICER_ROLE,
+    "alliance_leader_role": ALLIANCE_LEADER_ROLE,
+    "clans": ALLOWED_CLANS,
+    "events": ALLOWED_EVENTS_LIST,
+})
+
 # Initialize bot and intents
 intents = discord.Intents.default()
 intents.members = True  # Required to access guild member information
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Shards are picked by Discord from the number of guilds the bot is in
+bot = commands.AutoShardedBot(command_prefix="!", intents=intents)
 dkp_data_file = "dkp_data.json"
 leaderboard_data_file = "leaderboard_data.json"
 dkp_archive_file = "dkp_archive.json"
 alliance_dkp_data_file = "alliance_dkp_data.json"
+dkp_meta_file = "dkp_meta.json"
+dkp_ledger_file = "dkp_ledger.jsonl"
+dkp_history_file = "dkp_history.jsonl"
+leaderboard_history_dir = "leaderboard_history"
+dkp_database_file = "dkp_data.sqlite3"
+command_sync_file = "command_sync.json"
+
+def open_json_store(config):
+    # Resident DKP state backed by the snapshot files plus an append-only ledger
+    path = functools.partial(os.path.join, config.data_dir)
+    return JsonStore(
+        {
+            DKP: path(dkp_data_file),
+            LEADERBOARD: path(leaderboard_data_file),
+            ARCHIVE: path(dkp_archive_file),
+            ALLIANCE: path(alliance_dkp_data_file),
+            META: path(dkp_meta_file),
+        },
+        path(dkp_ledger_file),
+        compact_threshold=DATA_COMPACT_THRESHOLD,
+        data_format=DATA_FORMAT,
+        history_dir=path(leaderboard_history_dir),
+        transactions_file=path(dkp_history_file),
+    )
+
+# Each guild's data lives in its own directory
+def open_store(config):
+    os.makedirs(config.data_dir, exist_ok=True)
+    if DATA_BACKEND == "json":
+        store = open_json_store(config)
+        store.load()
+        return store
+
+    if DATA_BACKEND == "sqlite":
+        database_file = os.path.join(config.data_dir, dkp_database_file)
+        if not os.path.exists(database_file) and os.path.exists(os.path.join(config.data_dir, dkp_data_file)):
+            # First start on SQLite: import the existing JSON data once. The
+            # import goes to a temporary database that only replaces the real
+            # one when it succeeds, so a failed import is retried next start.
+            migrating_file = f"{database_file}.migrating"
+            for file in (migrating_file, f"{migrating_file}-wal", f"{migrating_file}-shm"):
+                if os.path.exists(file):
+                    os.remove(file)
+            store = SqliteStore(migrating_file)
+            store.load()
+            try:
+                migrate_json_to_sqlite(open_json_store(config), store)
+            finally:
+                store.close()
+            os.replace(migrating_file, database_file)
+
+        store = SqliteStore(database_file)
+        store.load()
+        return store
+
+    raise ValueError(f"Unknown DATA_BACKEND '{DATA_BACKEND}'. Use 'json' or 'sqlite'.")
+
+# Apply a window of member role changes to a guild's leaderboards in one batch
+async def apply_role_changes(context, joined, left):
+    started = time.perf_counter()
+    restored, added, archived = await context.store.update_roster(joined, left)
+    logger.info(
+        f"Applied {len(joined) + len(left)} member role change(s) in guild {context.guild_id} in {time.perf_counter() - started:.2f}s: "
+        f"{restored} restored, {added} added, {archived} archived."
+    )
 
-# Ensure DKP and leaderboard data files exist
-def ensure_data_files():
-    for file in [dkp_data_file, leaderboard_data_file, dkp_archive_file, alliance_dkp_data_file]:
-        if not os.path.exists(file):
-            with open(file, "w") as f:
-                json.dump({}, f)
-
-ensure_data_files()
-
-# Load and save data
-def load_data(file):
-    with open(file, "r") as f:
-        return json.load(f)
-
-def save_data(file, data):
-    with open(file, "w") as f:
-        json.dump(data, f, indent=4)
-
-# Function to handle role changes
-async def add_member_to_leaderboards(member: discord.Member):
-    dkp_data = load_data(dkp_data_file)
-    leaderboard_data = load_data(leaderboard_data_file)
-    archive_data = load_data(dkp_archive_file)
-
-    member_id = str(member.id)
-
-    if member_id in archive_data:
-        # Restore DKP from archive
-        dkp_data[member_id] = archive_data.pop(member_id)
-        save_data(dkp_archive_file, archive_data)
-    elif member_id not in dkp_data:
-        dkp_data[member_id] = 0
-
-    current_month = datetime.now().strftime("%Y-%m")
-    if member_id not in leaderboard_data:
-        leaderboard_data[member_id] = {}
-    if current_month not in leaderboard_data[member_id]:
-        leaderboard_data[member_id][current_month] = 0
-
-    save_data(dkp_data_file, dkp_data)
-    save_data(leaderboard_data_file, leaderboard_data)
-
-async def remove_member_from_leaderboards(member: discord.Member):
-    dkp_data = load_data(dkp_data_file)
-    leaderboard_data = load_data(leaderboard_data_file)
-    archive_data = load_data(dkp_archive_file)
-
-    member_id = str(member.id)
-
-    if member_id in dkp_data:
-        archive_data[member_id] = dkp_data.pop(member_id)
-        leaderboard_data.pop(member_id)
-        save_data(dkp_data_file, dkp_data)
-        save_data(leaderboard_data_file, leaderboard_data)
-        save_data(dkp_archive_file, archive_data)
+guild_contexts = {
+    guild_id: GuildContext(config, open_store(config), LEADERBOARD_PAGE_SIZE, ROLE_UPDATE_WINDOW, apply_role_changes)
+    for guild_id, config in GUILD_CONFIGS.items()
+}
+
+# Rate limits apply to the bot as a whole, so all guilds share one queue
+announcements = AnnouncementQueue(ANNOUNCE_WINDOW)
+
+# Confirm a DKP change to the user who made it and queue its public
+# announcement in the channel. The confirmation is ephemeral, so it does not
+# count against the channel's rate limit, and the command returns without
+# waiting for the announcement to be sent. The announcement is a plain
+# channel message rather than an interaction reply, so it names the user
+# unless the text already starts with them.
+async def announce(interaction: discord.Interaction, text):
+    await interaction.followup.send(text, ephemeral=True)
+    if not text.startswith(interaction.user.mention):
+        text = f"{interaction.user.mention}: {text}"
+    announcements.post(interaction.channel, text)
+
+# Channels commands are restricted to, by setting, with the reply when used anywhere else
+DKP_CHANNEL = ("dkp_channel_id", "This command can only be used in a #dkp channel.")
+ALLIANCE_ADDREMOVE_CHANNEL = ("alliance_addremove_channel_id", "This command can only be used in the allowed channel.")
+ALLIANCE_SHOW_CHANNEL = ("alliance_show_channel_id", "This command can only be used in the designated DKP channel.")
+
+# Whether the user holds a command permission: "administrator" or
+# "manage_guild", MEMBER for the member role, or OFFICER and ALLIANCE_LEADER
+# for administrators and holders of that role
+def permitted(context, user, permission):
+    if permission in ("administrator", "manage_guild"):
+        return getattr(user.guild_permissions, permission)
+    if permission == MEMBER:
+        return context.roles.has(user, MEMBER)
+    return user.guild_permissions.administrator or context.roles.has(user, permission)
+
+# Guild, channel and permission checks shared by the commands. Returns the
+# guild's context, or replies with the reason and returns None when the user
+# may not run the command here. threads=True also accepts threads under the channel.
+async def authorize(interaction: discord.Interaction, permission=None, channel=None, threads=False):
+    context = None if interaction.guild is None else guild_contexts.get(interaction.guild.id)
+    if context is None:
+        await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
+        return None
+
+    context.roles.resolve(interaction.guild)
+    if channel is not None:
+        setting, message = channel
+        channel_id = getattr(context.config, setting)
+        in_thread = threads and isinstance(interaction.channel, discord.Thread) and interaction.channel.parent_id == channel_id
+        if interaction.channel.id != channel_id and not in_thread:
+            await interaction.followup.send(message, ephemeral=True)
+            return None
+
+    if permission is not None and not permitted(context, interaction.user, permission):
+        await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        return None
+    return context
 
 # Events for role updates
 @bot.event
 async def on_member_update(before: discord.Member, after: discord.Member):
-    guild = after.guild
-    role = discord.utils.get(guild.roles, name=MEMBER_ROLE)
+    context = guild_contexts.get(after.guild.id)
+    if context is None:
+        return
+    with metrics.timed("dkp_member_update_seconds"):
+        context.roles.resolve(after.guild)
+        was_member = context.roles.has(before, MEMBER)
+        is_member = context.roles.has(after, MEMBER)
+        # Nickname, avatar and other role changes leave the member role as is
+        if was_member == is_member:
+            return
+
+        context.role_changes.push(str(after.id), was_member, is_member)
 
-    if role in after.roles and role not in before.roles:
-        await add_member_to_leaderboards(after)
-    elif role not in after.roles and role in before.roles:
-        await remove_member_from_leaderboards(after)
+# Keep the resolved role IDs in step with the guild's roles
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    if role.guild.id in guild_contexts:
+        guild_contexts[role.guild.id].roles.refresh(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    if after.guild.id in guild_contexts and before.name != after.name:
+        guild_contexts[after.guild.id].roles.refresh(after.guild)
 
-# Initialize leaderboard from current members
-async def initialize_leaderboard():
-    guild = bot.get_guild(GUILD_ID)
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    if role.guild.id in guild_contexts:
+        guild_contexts[role.guild.id].roles.refresh(role.guild)
+
+# Initialize a guild's leaderboard from its current members
+async def initialize_leaderboard(context):
+    guild = bot.get_guild(context.guild_id)
     if not guild:
-        logger.error("Guild not found. Ensure the bot is added to the guild and the GUILD_ID is correct.")
+        logger.error(f"Guild {context.guild_id} not found. Ensure the bot is added to the guild and its ID is correct.")
         return
 
-    role = discord.utils.get(guild.roles, name=MEMBER_ROLE)
-    if not role:
-        logger.error(f"Role '{MEMBER_ROLE}' not found in the guild.")
+    context.roles.refresh(guild)
+    if not context.roles.ids[MEMBER]:
+        logger.error(f"Role '{context.config.member_role}' not found in guild {context.guild_id}.")
         return
 
-    for member in guild.members:
-        if role in member.roles:
-            await add_member_to_leaderboards(member)
+    started = time.perf_counter()
+    member_ids = [str(member.id) for member in guild.members if context.roles.has(member, MEMBER)]
+    restored, added, archived = await context.store.reconcile(member_ids)
+    logger.info(
+        f"Reconciled {len(member_ids)} member(s) of guild {context.guild_id} in {time.perf_counter() - started:.2f}s: "
+        f"{restored} restored, {added} added, {archived} archived."
+    )
+
+# Map a leaderboard time frame to its month ("YYYY-MM", None for overall) and title
+TIME_FRAME_HELP = (
+    "'overall', 'current', 'last', a month like 2026-01, a range like 2026-01..2026-06, "
+    "a quarter like 2026-Q1, or 'last N' for the last N months"
+)
+
+# Parse a leaderboard time frame into (months, title). months is None for the
+# overall board or a (first, last) pair of "YYYY-MM" months, inclusive. Months
+# are compared as strings, so only four-digit years are accepted.
+def resolve_time_frame(time_frame):
+    unknown = ValueError(f"Unknown time frame '{time_frame}'. Use {TIME_FRAME_HELP}.")
+    frame = time_frame.strip().lower()
+    now = datetime.now()
+    if frame == "overall":
+        return None, "Overall"
+    if frame == "current":
+        month = now.strftime("%Y-%m")
+        return (month, month), "Current Month"
+    if frame == "last":
+        month = (now - relativedelta(months=1)).strftime("%Y-%m")
+        return (month, month), "Last Month"
+
+    match = re.fullmatch(r"last\s*(\d+)(?:\s*months?)?", frame)
+    if match and int(match.group(1)) > 0:
+        count = int(match.group(1))
+        # Reaching further back than January of the year 1000 is not a month
+        if count - 1 > (now.year - 1000) * 12 + now.month - 1:
+            raise unknown
+        first = (now - relativedelta(months=count - 1)).strftime("%Y-%m")
+        return (first, now.strftime("%Y-%m")), f"Last {count} Month{'s' if count > 1 else ''}"
+
+    match = re.fullmatch(r"(\d{4})-?q([1-4])", frame)
+    if match:
+        year, quarter = match.group(1), int(match.group(2))
+        if int(year) < 1000:
+            raise unknown
+        return (f"{year}-{quarter * 3 - 2:02d}", f"{year}-{quarter * 3:02d}"), f"{year} Q{quarter}"
+
+    try:
+        first, _, last = frame.partition("..")
+        first = datetime.strptime(first.strip(), "%Y-%m")
+        last = datetime.strptime(last.strip(), "%Y-%m") if last else first
+    except ValueError:
+        raise unknown
+    if first.year < 1000 or last.year < 1000:
+        raise unknown
+    first, last = first.strftime("%Y-%m"), last.strftime("%Y-%m")
+    if first > last:
+        raise ValueError(f"Time frame '{time_frame}' ends before it starts.")
+    return (first, last), first if first == last else f"{first} to {last}"
+
+# Decay is applied once per period, keyed by ISO week or by month
+def decay_period(now=None):
+    now = now or datetime.now()
+    if DKP_DECAY_SCHEDULE == "weekly":
+        year, week, _ = now.isocalendar()
+        return f"{year}-W{week:02d}"
+    return now.strftime("%Y-%m")
+
+# Send the first page of a board, with navigation buttons when it has more
+async def send_paged(interaction: discord.Interaction, render):
+    content, page_count = await render(0)
+    if page_count > 1:
+        await interaction.followup.send(content, view=PageView(interaction.user.id, render, page_count))
+    else:
+        await interaction.followup.send(content)
+
+# Parse a history bound, a day (YYYY-MM-DD) or a month (YYYY-MM) in local
+# time, into a timestamp: its first second, or its last one when end is set
+def parse_history_date(value, end=False):
+    for date_format, length in (("%Y-%m-%d", relativedelta(days=1)), ("%Y-%m", relativedelta(months=1))):
+        try:
+            start = datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            continue
+        return int((start + length).timestamp()) - 1 if end else int(start.timestamp())
+    raise ValueError(f"Invalid date '{value}'. Use a day like 2026-01-31 or a month like 2026-01.")
+
+# Send rows from an async iterator of row lists as CSV attachments of about
+# EXPORT_FILE_BYTES each, so only one file is held in memory at a time.
+# Returns the number of rows and files sent.
+async def send_csv(interaction: discord.Interaction, name, header, chunks):
+    rows = files = 0
+    buffer = None
+
+    async def send():
+        nonlocal files
+        files += 1
+        data = io.BytesIO(buffer.getvalue().encode())
+        await interaction.followup.send(file=discord.File(data, filename=f"{name}-{files}.csv"), ephemeral=True)
+
+    async for chunk in chunks:
+        for row in chunk:
+            if buffer is not None and buffer.tell() >= EXPORT_FILE_BYTES:
+                await send()
+                buffer = None
+            if buffer is None:
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(header)
+            writer.writerow(row)
+            rows += 1
+    if buffer is not None:
+        await send()
+    return rows, files
 
 # DKP management cog
 class DKPManager(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        # Bind commands to the specific guild
-        self.bot.tree.add_command(self.dkp_add, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_remove, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_cancel, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_show, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_trade, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_leaderboard, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_archive, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_alliance_add, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_alliance_remove, guild=discord.Object(id=GUILD_ID))
-        self.bot.tree.add_command(self.dkp_alliance_show, guild=discord.Object(id=GUILD_ID))
-
+        # Bind commands to every configured guild
+        guilds = [discord.Object(id=guild_id) for guild_id in guild_contexts]
+        self.bot.tree.add_command(self.dkp_add, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_bulk_add, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_remove, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_cancel, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_show, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_rank, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_trade, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_leaderboard, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_archive, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_stats, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_decay_preview, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_history, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_export, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_alliance_add, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_alliance_remove, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_alliance_show, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_alliance_bulk_add, guilds=guilds)
+        self.bot.tree.add_command(self.dkp_alliance_board, guilds=guilds)
+
+        self.metrics_server = None
+        self.flush_data.start()
+        self.month_rollover.start()
+        self.apply_decay.start()
+
+    async def cog_load(self):
+        if METRICS_PORT:
+            self.metrics_server = await metrics.serve("127.0.0.1", METRICS_PORT)
+
+    async def cog_unload(self):
+        self.flush_data.cancel()
+        self.month_rollover.cancel()
+        self.apply_decay.cancel()
+        for context in guild_contexts.values():
+            await context.role_changes.flush()
+            await context.store.flush()
+        await announcements.flush()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
+    # Sync the ledger to disk and compact it once it grows large
+    @tasks.loop(seconds=DATA_FLUSH_INTERVAL)
+    async def flush_data(self):
+        for context in guild_contexts.values():
+            await context.store.flush()
+        if METRICS_FILE:
+            metrics.write_file(METRICS_FILE)
+
+    # Close out finished months shortly after each month starts: freeze their
+    # final rankings and move months older than LEADERBOARD_HOT_MONTHS to the
+    # history files. Runs hourly and does nothing until a month has ended.
+    @tasks.loop(hours=1)
+    async def month_rollover(self):
+        for context in guild_contexts.values():
+            started = time.perf_counter()
+            expired = await context.store.rollover(LEADERBOARD_HOT_MONTHS)
+            if expired:
+                logger.info(
+                    f"Moved {len(expired)} month(s) of guild {context.guild_id} to the leaderboard history "
+                    f"in {time.perf_counter() - started:.2f}s: {', '.join(expired)}."
+                )
+
+    # Apply the configured decay once per week or month, the first time this
+    # loop runs in a new period
+    @tasks.loop(hours=1)
+    async def apply_decay(self):
+        if DKP_DECAY_PERCENT <= 0:
+            return
+        period = decay_period()
+        for context in guild_contexts.values():
+            if await context.store.last_decay() == period:
+                continue
+            with metrics.timed("dkp_decay_seconds"):
+                changes = await context.store.decay(DKP_DECAY_PERCENT, DKP_DECAY_FLOOR, period)
+            removed = sum(old - new for _, old, new in changes)
+            logger.info(
+                f"Applied {DKP_DECAY_PERCENT:g}% DKP decay for {period} in guild {context.guild_id}: "
+                f"{len(changes)} member(s) lost {removed} DKP in total."
+            )
 
     @app_commands.command(name="dkp_add", description="Add DKP to a guild member.")
     @app_commands.describe(
         member="The member to add DKP to.",
         amount="The amount of DKP to add."
     )
+    @instrument_command
     async def dkp_add(self, interaction: discord.Interaction, member: discord.Member, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
+        await interaction.response.defer(ephemeral=True)
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
+        context = await authorize(interaction, OFFICER)
+        if context is None:
             return
 
-        #if not interaction.user.guild_permissions.manage_guild:
-        if not interaction.user.guild_permissions.administrator and not any(role.name == OFFICER_ROLE for role in interaction.user.roles):
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
-            return
-        
-        if not any(role.name == MEMBER_ROLE for role in member.roles):
+        if not context.roles.has(member, MEMBER):
             await interaction.followup.send("Target is not a Member.", ephemeral=True)
             return
 
@@ -183,49 +484,84 @@ class DKPManager(commands.Cog):
             await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
             return
 
-        # Load current DKP and leaderboard data
-        dkp_data = load_data(dkp_data_file)
-        leaderboard_data = load_data(leaderboard_data_file)
+        # Update DKP and monthly leaderboard
+        new_dkp = await context.store.add(str(member.id), amount, actor=str(interaction.user.id))
 
-        member_id = str(member.id)
-        if member_id not in dkp_data:
-            dkp_data[member_id] = 0
+        logger.info(f"{interaction.user.name} added {amount} DKP for {member.name}. New DKP: {new_dkp}")
+
+        await announce(interaction, f"Added {amount} DKP to {member.mention}. Current DKP: {new_dkp}")
 
-        dkp_data[member_id] += amount
-        save_data(dkp_data_file, dkp_data)
+    @app_commands.command(name="dkp_bulk_add", description="Add DKP to everyone in a voice channel, a role or a list of mentions.")
+    @app_commands.describe(
+        amount="The amount of DKP to add to each member.",
+        channel="Voice channel whose members get DKP (optional).",
+        role="Role whose members get DKP (optional).",
+        members="Mentions or IDs of members who get DKP (optional)."
+    )
+    @instrument_command
+    async def dkp_bulk_add(self, interaction: discord.Interaction, amount: int, channel: discord.VoiceChannel = None, role: discord.Role = None, members: str = None):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer(ephemeral=True)
 
-        # Update monthly leaderboard
-        current_month = datetime.now().strftime("%Y-%m")
-        if member_id not in leaderboard_data:
-            leaderboard_data[member_id] = {}
-        if current_month not in leaderboard_data[member_id]:
-            leaderboard_data[member_id][current_month] = 0
+        context = await authorize(interaction, OFFICER)
+        if context is None:
+            return
 
-        leaderboard_data[member_id][current_month] += amount
-        save_data(leaderboard_data_file, leaderboard_data)
+        if amount < 0:
+            await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
+            return
 
-        logger.info(f"{interaction.user.name} added {amount} DKP for {member.name}. New DKP: {dkp_data[member_id]}")
+        if channel is None and role is None and not members:
+            await interaction.followup.send("Select a voice channel, a role or a list of members.", ephemeral=True)
+            return
+
+        # Collect candidates from every given source, duplicates collapse by ID
+        candidates = {}
+        for source in (channel, role):
+            if source is not None:
+                candidates.update((member.id, member) for member in source.members)
+        for member_id in re.findall(r"\d{15,20}", members or ""):
+            member = interaction.guild.get_member(int(member_id))
+            if member is not None:
+                candidates[member.id] = member
+
+        eligible = [member for member in candidates.values() if context.roles.has(member, MEMBER)]
+        if not eligible:
+            await interaction.followup.send("None of the selected users is a Member.", ephemeral=True)
+            return
 
-        await interaction.followup.send(f"Added {amount} DKP to {member.mention}. Current DKP: {dkp_data[member_id]}")
+        # Update DKP and monthly leaderboard for everyone at once
+        await context.store.add_many([str(member.id) for member in eligible], amount, actor=str(interaction.user.id))
+
+        logger.info(f"{interaction.user.name} added {amount} DKP for {len(eligible)} member(s): {', '.join(member.name for member in eligible)}")
+
+        skipped = len(candidates) - len(eligible)
+        summary = f"Added {amount} DKP to {len(eligible)} member(s)"
+        if skipped:
+            summary += f" ({skipped} skipped, not a Member)"
+        mentions = ""
+        for idx, member in enumerate(eligible):
+            if len(summary) + len(mentions) + len(member.mention) > 1900:
+                mentions += f" and {len(eligible) - idx} more"
+                break
+            mentions += (", " if mentions else ": ") + member.mention
+        await announce(interaction, summary + mentions)
 
     @app_commands.command(name="dkp_remove", description="Remove DKP from a guild member.")
     @app_commands.describe(
         member="The member to remove DKP from.",
         amount="The amount of DKP to remove."
     )
+    @instrument_command
     async def dkp_remove(self, interaction: discord.Interaction, member: discord.Member, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
+        await interaction.response.defer(ephemeral=True)
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
+        context = await authorize(interaction, "manage_guild")
+        if context is None:
             return
 
-        if not interaction.user.guild_permissions.manage_guild:
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
-            return
-        
-        if not any(role.name == MEMBER_ROLE for role in member.roles):
+        if not context.roles.has(member, MEMBER):
             await interaction.followup.send("Target is not a Member.", ephemeral=True)
             return
 
@@ -233,22 +569,15 @@ class DKPManager(commands.Cog):
             await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
             return
 
-        # Load current DKP data
-        dkp_data = load_data(dkp_data_file)
-
-        member_id = str(member.id)
-        if member_id not in dkp_data:
-            dkp_data[member_id] = 0
-
-        if dkp_data[member_id] < amount:
-            await interaction.followup.send(f"You cant remove more DKP than member have. Current {member.mention} DKP is: {dkp_data[member_id]}", ephemeral=True)
+        try:
+            new_dkp = await context.store.remove(str(member.id), amount, actor=str(interaction.user.id))
+        except InsufficientDKP as e:
+            await interaction.followup.send(f"You cant remove more DKP than member have. Current {member.mention} DKP is: {e.balance}", ephemeral=True)
             return
 
-        dkp_data[member_id] = max(0, dkp_data[member_id] - amount)
-        save_data(dkp_data_file, dkp_data)
-        logger.info(f"{interaction.user.name} removed {amount} DKP from {member.name}. New DKP: {dkp_data[member_id]}")
+        logger.info(f"{interaction.user.name} removed {amount} DKP from {member.name}. New DKP: {new_dkp}")
 
-        await interaction.followup.send(f"Removed {amount} DKP from {member.mention}. Current DKP: {dkp_data[member_id]}")
+        await announce(interaction, f"Removed {amount} DKP from {member.mention}. Current DKP: {new_dkp}")
 
 
     @app_commands.command(name="dkp_cancel", description="Cancel DKP from a guild member, including removing from monthly leaderboard.")
@@ -256,19 +585,16 @@ class DKPManager(commands.Cog):
         member="The member to remove DKP from.",
         amount="The amount of DKP to remove."
     )
+    @instrument_command
     async def dkp_cancel(self, interaction: discord.Interaction, member: discord.Member, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
+        await interaction.response.defer(ephemeral=True)
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
+        context = await authorize(interaction, "manage_guild")
+        if context is None:
             return
 
-        if not interaction.user.guild_permissions.manage_guild:
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
-            return
-        
-        if not any(role.name == MEMBER_ROLE for role in member.roles):
+        if not context.roles.has(member, MEMBER):
             await interaction.followup.send("Target is not a Member.", ephemeral=True)
             return
 
@@ -276,127 +602,270 @@ class DKPManager(commands.Cog):
             await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
             return
 
-        # Load current DKP and leaderboard data
-        dkp_data = load_data(dkp_data_file)
-        leaderboard_data = load_data(leaderboard_data_file)
-
-        member_id = str(member.id)
-        if member_id not in dkp_data:
-            dkp_data[member_id] = 0
-
-        if dkp_data[member_id] < amount:
-            await interaction.followup.send(f"You cant remove more DKP than member have. Current {member.mention} DKP is: {dkp_data[member_id]}", ephemeral=True)
+        # Update DKP and monthly leaderboard
+        try:
+            new_dkp = await context.store.cancel(str(member.id), amount, actor=str(interaction.user.id))
+        except InsufficientDKP as e:
+            await interaction.followup.send(f"You cant remove more DKP than member have. Current {member.mention} DKP is: {e.balance}", ephemeral=True)
             return
 
-        dkp_data[member_id] = max(0, dkp_data[member_id] - amount)
-        save_data(dkp_data_file, dkp_data)
+        logger.info(f"{interaction.user.name} removed {amount} DKP from {member.name}. New DKP: {new_dkp}")
 
-        # Update monthly leaderboard
-        current_month = datetime.now().strftime("%Y-%m")
-        if member_id not in leaderboard_data:
-            leaderboard_data[member_id] = {}
-        if current_month not in leaderboard_data[member_id]:
-            leaderboard_data[member_id][current_month] = 0
-
-        leaderboard_data[member_id][current_month] -= amount
-        save_data(leaderboard_data_file, leaderboard_data)
-        
-        logger.info(f"{interaction.user.name} removed {amount} DKP from {member.name}. New DKP: {dkp_data[member_id]}")
-
-        await interaction.followup.send(f"Canceled {amount} DKP from {member.mention}. Current DKP: {dkp_data[member_id]}")
+        await announce(interaction, f"Canceled {amount} DKP from {member.mention}. Current DKP: {new_dkp}")
 
     @app_commands.command(name="dkp_show", description="Show the current DKP of a guild member.")
     @app_commands.describe(
         member="The member whose DKP to view (optional)."
     )
+    @instrument_command
     async def dkp_show(self, interaction: discord.Interaction, member: discord.Member = None):
         # Use defer to avoid timeout issues
         await interaction.response.defer()
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
-            return
-        
-        if interaction.channel.id != ALLOWED_DKP_SHOW_CHANNEL_ID:
-            await interaction.followup.send("This command can only be used in a #dkp channel.", ephemeral=True)
+        context = await authorize(interaction, MEMBER, DKP_CHANNEL)
+        if context is None:
             return
 
-        if not any(role.name == MEMBER_ROLE for role in interaction.user.roles):
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        member_id = str(interaction.user.id if member is None else member.id)
+        current_dkp = await context.store.balance(member_id)
+        target = "your" if member is None else f"{member.mention}'s"
+
+        await interaction.followup.send(f"{interaction.user.mention}, {target} current DKP is: {current_dkp}")
+
+    @app_commands.command(name="dkp_rank", description="Show the leaderboard position of a guild member.")
+    @app_commands.describe(
+        member="The member whose position to view (optional).",
+        time_frame="'overall' (default), 'current', 'last', 2026-01, 2026-01..2026-06, 2026-Q1 or 'last 3'."
+    )
+    @instrument_command
+    async def dkp_rank(self, interaction: discord.Interaction, member: discord.Member = None, time_frame: str = "overall"):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer()
+
+        context = await authorize(interaction, MEMBER, DKP_CHANNEL)
+        if context is None:
             return
 
-        # Load current DKP data
-        dkp_data = load_data(dkp_data_file)
+        try:
+            months, title = resolve_time_frame(time_frame)
+        except ValueError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+            return
 
         member_id = str(interaction.user.id if member is None else member.id)
-        current_dkp = dkp_data.get(member_id, 0)
-        target = "your" if member is None else f"{member.mention}'s"
+        if months is None:
+            position = await context.store.rank(member_id)
+        else:
+            position = await context.store.range_rank(member_id, *months)
+        target = "you are" if member is None else f"{member.mention} is"
 
-        await interaction.followup.send(f"{interaction.user.mention}, {target} current DKP is: {current_dkp}")
+        if position is None:
+            await interaction.followup.send(f"{interaction.user.mention}, {target} not on the {title.lower()} leaderboard.")
+            return
+
+        rank, dkp, total = position
+        await interaction.followup.send(f"{interaction.user.mention}, {target} #{rank} of {total} on the {title.lower()} leaderboard with {dkp} DKP.")
 
     @app_commands.command(name="dkp_archive", description="Show archived DKP data (admin only).")
-    async def dkp_archive(self, interaction: discord.Interaction):
+    @app_commands.describe(
+        member="Archived member to look up, by name or ID (optional)."
+    )
+    @instrument_command
+    async def dkp_archive(self, interaction: discord.Interaction, member: str = None):
         # Use defer to avoid timeout issues
         await interaction.response.defer()
 
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        context = await authorize(interaction, "administrator")
+        if context is None:
+            return
+
+        if member is not None:
+            member_id = member.strip().strip("<@!>")
+            balance = await context.store.archived_balance(member_id)
+            if balance is None:
+                await interaction.followup.send("That member is not in the DKP archive.", ephemeral=True)
+                return
+            await interaction.followup.send(f"<@{member_id}> is archived with {balance} DKP. They are restored with it when they get the member role again.")
             return
 
-        archive_data = load_data(dkp_archive_file)
-        if not archive_data:
+        if not await context.store.archive_size():
             await interaction.followup.send("The DKP archive is empty.", ephemeral=True)
             return
 
-        archive_message = "**DKP Archive:**\n" + "\n".join(
-            [f"<@{member_id}>: {dkp}" for member_id, dkp in archive_data.items()]
-        )
-        await interaction.followup.send(archive_message)
+        await send_paged(interaction, context.page_cache.archive)
+
+    @app_commands.command(name="dkp_stats", description="Show command latency and storage statistics (admin only).")
+    @instrument_command
+    async def dkp_stats(self, interaction: discord.Interaction):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer(ephemeral=True)
+
+        context = await authorize(interaction, "administrator")
+        if context is None:
+            return
+
+        def ms(seconds):
+            return "> 10 s" if seconds == float("inf") else f"≤ {seconds * 1000:g} ms"
+
+        with metrics.lock:
+            histograms = sorted(metrics.histograms.items())
+            gauges = sorted(metrics.gauges.items())
+
+        lines = ["**DKP bot stats:**", "Commands:"]
+        for (name, key), histogram in histograms:
+            if name != "dkp_command_duration_seconds":
+                continue
+            command = dict(key)["command"]
+            failed = metrics.counter("dkp_interactions_total", command=command, outcome="failed")
+            lines.append(f"`{command}`: {histogram.count} call(s), p50 {ms(histogram.quantile(0.5))}, p99 {ms(histogram.quantile(0.99))}, {failed} failed")
+
+        member_updates = metrics.histogram("dkp_member_update_seconds")
+        if member_updates is not None:
+            lines.append(f"Member updates: {member_updates.count}, p99 {ms(member_updates.quantile(0.99))}")
+
+        lines.append("Files:")
+        for (name, key), size in gauges:
+            if name == "dkp_file_size_bytes":
+                file = dict(key)["file"]
+                written = metrics.counter("dkp_file_written_bytes_total", file=file)
+                lines.append(f"`{file}`: {size / 1024:.1f} KiB, {written / 1024:.1f} KiB written")
+
+        await interaction.followup.send("\n".join(lines)[:2000], ephemeral=True)
+
+    @app_commands.command(name="dkp_decay_preview", description="Preview the effect of DKP decay without applying it (admin only).")
+    @app_commands.describe(
+        percent="Percent to preview (default: the configured decay).",
+        floor="Balance floor to preview (default: the configured floor)."
+    )
+    @instrument_command
+    async def dkp_decay_preview(self, interaction: discord.Interaction, percent: float = None, floor: int = None):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer(ephemeral=True)
+
+        context = await authorize(interaction, "administrator")
+        if context is None:
+            return
+
+        percent = DKP_DECAY_PERCENT if percent is None else percent
+        floor = DKP_DECAY_FLOOR if floor is None else floor
+        if not 0 < percent <= 100:
+            await interaction.followup.send("DKP decay is disabled. Pass a percent between 0 and 100 to preview one.", ephemeral=True)
+            return
+
+        changes = await context.store.decay(percent, floor, decay_period(), dry_run=True)
+        last_decay = await context.store.last_decay()
+        lines = [
+            f"**DKP decay preview:** {percent:g}% {DKP_DECAY_SCHEDULE}, floor {floor}. Last applied: {last_decay or 'never'}.",
+            f"{len(changes)} member(s) would lose {sum(old - new for _, old, new in changes)} DKP in total.",
+        ]
+        if changes:
+            lines.append("Largest reductions:")
+            largest = heapq.nsmallest(10, changes, key=lambda change: (change[2] - change[1], change[0]))
+            lines += [f"<@{member_id}>: {old} → {new} (-{old - new})" for member_id, old, new in largest]
+        await interaction.followup.send("\n".join(lines)[:2000], ephemeral=True)
+
+    @app_commands.command(name="dkp_history", description="Show the DKP changes of a guild member.")
+    @app_commands.rename(since="from", until="to")
+    @app_commands.describe(
+        member="The member whose history to view.",
+        since="First day (2026-01-31) or month (2026-01) to include (optional).",
+        until="Last day (2026-01-31) or month (2026-01) to include (optional)."
+    )
+    @instrument_command
+    async def dkp_history(self, interaction: discord.Interaction, member: discord.Member, since: str = None, until: str = None):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer()
+
+        context = await authorize(interaction, MEMBER, DKP_CHANNEL)
+        if context is None:
+            return
+
+        try:
+            first = None if since is None else parse_history_date(since)
+            last = None if until is None else parse_history_date(until, end=True)
+        except ValueError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+            return
+
+        member_id = str(member.id)
+        if not await context.store.history_size(member_id, first, last):
+            await interaction.followup.send(f"{member.mention} has no DKP history in that time frame.", ephemeral=True)
+            return
+
+        await send_paged(interaction, lambda page: context.page_cache.history(member_id, first, last, page))
+
+    @app_commands.command(name="dkp_export", description="Export the DKP history or balances as CSV files (admin only).")
+    @app_commands.rename(since="from", until="to")
+    @app_commands.describe(
+        data="'history' (default) or 'balances'.",
+        since="First day (2026-01-31) or month (2026-01) of history to include (optional).",
+        until="Last day (2026-01-31) or month (2026-01) of history to include (optional)."
+    )
+    @instrument_command
+    async def dkp_export(self, interaction: discord.Interaction, data: str = "history", since: str = None, until: str = None):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer(ephemeral=True)
+
+        context = await authorize(interaction, "administrator")
+        if context is None:
+            return
+
+        if data == "balances":
+            async def rows():
+                async for chunk in context.store.export_balances():
+                    yield [
+                        (member_id, getattr(interaction.guild.get_member(int(member_id)), "name", ""), balance, "archived" if archived else "tracked")
+                        for member_id, balance, archived in chunk
+                    ]
+            header = ("member_id", "name", "balance", "status")
+        elif data == "history":
+            try:
+                first = None if since is None else parse_history_date(since)
+                last = None if until is None else parse_history_date(until, end=True)
+            except ValueError as e:
+                await interaction.followup.send(str(e), ephemeral=True)
+                return
+
+            async def rows():
+                async for chunk in context.store.export_history(first, last):
+                    yield [
+                        (datetime.fromtimestamp(ts).isoformat(), actor or "", member_id, amount, balance, kind)
+                        for ts, actor, member_id, amount, balance, kind in chunk
+                    ]
+            header = ("time", "actor_id", "member_id", "amount", "balance", "kind")
+        else:
+            await interaction.followup.send("Choose 'history' or 'balances'.", ephemeral=True)
+            return
+
+        count, files = await send_csv(interaction, f"dkp-{data}", header, rows())
+
+        logger.info(f"{interaction.user.name} exported {count} {data} row(s) in {files} file(s).")
+
+        if not count:
+            await interaction.followup.send("Nothing to export.", ephemeral=True)
+        else:
+            await interaction.followup.send(f"Exported {count} row(s) in {files} file(s).", ephemeral=True)
 
     @app_commands.command(name="dkp_leaderboard", description="Show the DKP leaderboard.")
     @app_commands.describe(
-        time_frame="Time frame for the leaderboard: 'overall', 'current', or 'last' (default: overall)."
+        time_frame="'overall' (default), 'current', 'last', 2026-01, 2026-01..2026-06, 2026-Q1 or 'last 3'."
     )
+    @instrument_command
     async def dkp_leaderboard(self, interaction: discord.Interaction, time_frame: str = "overall"):
         # Use defer to avoid timeout issues
         await interaction.response.defer()
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
-            return
-        
-        #if not interaction.user.guild_permissions.manage_guild:
-        if not interaction.user.guild_permissions.administrator and not any(role.name == OFFICER_ROLE for role in interaction.user.roles):
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
-            return
-
-        dkp_data = load_data(dkp_data_file)
-        leaderboard_data = load_data(leaderboard_data_file)
-
-        if time_frame.lower() == "current":
-            current_month = datetime.now().strftime("%Y-%m")
-            monthly_leaderboard = {
-                member_id: months.get(current_month, 0)
-                for member_id, months in leaderboard_data.items()
-            }
-            sorted_leaderboard = sorted(monthly_leaderboard.items(), key=lambda x: x[1], reverse=True)
-            leaderboard_message = "**Current Month DKP Leaderboard:**\n"
-        elif time_frame.lower() == "last":
-            last_month = (datetime.now() - relativedelta(months=1)).strftime("%Y-%m")
-            monthly_leaderboard = {
-                member_id: months.get(last_month, 0)
-                for member_id, months in leaderboard_data.items()
-            }
-            sorted_leaderboard = sorted(monthly_leaderboard.items(), key=lambda x: x[1], reverse=True)
-            leaderboard_message = "**Last Month DKP Leaderboard:**\n"
-        else:
-            sorted_leaderboard = sorted(dkp_data.items(), key=lambda x: x[1], reverse=True)
-            leaderboard_message = "**Overall DKP Leaderboard:**\n"
+        context = await authorize(interaction, OFFICER)
+        if context is None:
+            return
 
-        leaderboard_table = [f"{idx + 1}. <@{member_id}>: {dkp}" for idx, (member_id, dkp) in enumerate(sorted_leaderboard)]
-        leaderboard_message += "\n".join(leaderboard_table)
+        try:
+            months, title = resolve_time_frame(time_frame)
+        except ValueError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+            return
 
-        await interaction.followup.send(leaderboard_message)
+        await send_paged(interaction, lambda page: context.page_cache.leaderboard(months, title, page))
 
     @app_commands.command(name="dkp_alliance_add", description="Add DKP to an clan in the alliance.")
     @app_commands.describe(
@@ -404,30 +873,20 @@ class DKPManager(commands.Cog):
         member="The clan to add DKP to.",
         amount="The amount of DKP to add."
     )
+    @instrument_command
     async def dkp_alliance_add(self, interaction: discord.Interaction, event_type: str, member: str, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
-
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
-            return
+        await interaction.response.defer(ephemeral=True)
 
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        context = await authorize(interaction, "administrator", ALLIANCE_ADDREMOVE_CHANNEL, threads=True)
+        if context is None:
             return
 
-        if interaction.channel.id != ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID and (
-                not isinstance(interaction.channel,
-                               discord.Thread) or interaction.channel.parent_id != ALLOWED_ALLIANCE_DKP_ADDREMOVE_CHANNEL_ID
-        ):
-            await interaction.followup.send("This command can only be used in the allowed channel.", ephemeral=True)
-            return
-
-        if event_type not in ALLOWED_EVENTS_LIST:
+        if event_type not in context.config.events:
             await interaction.followup.send("Invalid event type selection.", ephemeral=True)
             return
 
-        if member not in ALLOWED_CLANS:
+        if member not in context.config.clans:
             await interaction.followup.send("Invalid clan selection.", ephemeral=True)
             return
 
@@ -435,21 +894,12 @@ class DKPManager(commands.Cog):
             await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
             return
 
-        dkp_data = load_data(alliance_dkp_data_file)
-
-        if member not in dkp_data:
-            dkp_data[member] = {}
-        if event_type not in dkp_data[member]:
-            dkp_data[member][event_type] = 0
+        new_dkp = await context.store.alliance_add(member, event_type, amount, actor=str(interaction.user.id))
 
-        dkp_data[member][event_type] += amount
+        logger.info(f"{interaction.user.name} added {amount} DKP for {member} clan. New DKP {event_type}: {new_dkp}")
 
-        save_data(alliance_dkp_data_file, dkp_data)
-
-        logger.info(f"{interaction.user.name} added {amount} DKP for {member} clan. New DKP {event_type}: {dkp_data[member][event_type]}")
-
-        await interaction.followup.send(
-            f"Added {amount} DKP to {member} clan. Current DKP for event {event_type}: {dkp_data[member][event_type]}")
+        await announce(interaction,
+            f"Added {amount} DKP to {member} clan. Current DKP for event {event_type}: {new_dkp}")
 
     @app_commands.command(name="dkp_alliance_remove", description="Remove DKP from a clan in the alliance.")
     @app_commands.describe(
@@ -457,19 +907,20 @@ class DKPManager(commands.Cog):
         member="Select the clan to remove DKP from.",
         amount="The amount of DKP to remove."
     )
+    @instrument_command
     async def dkp_alliance_remove(self, interaction: discord.Interaction, event_type: str, member: str, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
+        await interaction.response.defer(ephemeral=True)
 
-        if not interaction.user.guild_permissions.administrator:
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        context = await authorize(interaction, "administrator")
+        if context is None:
             return
 
-        if event_type not in ALLOWED_EVENTS_LIST:
+        if event_type not in context.config.events:
             await interaction.followup.send("Invalid event type selection.", ephemeral=True)
             return
 
-        if member not in ALLOWED_CLANS:
+        if member not in context.config.clans:
             await interaction.followup.send("Invalid clan selection.", ephemeral=True)
             return
 
@@ -477,74 +928,149 @@ class DKPManager(commands.Cog):
             await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
             return
 
-        dkp_data = load_data(alliance_dkp_data_file)
-
-        if member not in dkp_data:
-            dkp_data[member] = {}
-        if event_type not in dkp_data[member]:
-            dkp_data[member][event_type] = 0
-
-        if dkp_data[member][event_type] < amount:
-            await interaction.followup.send(f"You cannot remove more DKP than the clan has. Current DKP for event {event_type}: {dkp_data[member][event_type]}", ephemeral=True)
+        try:
+            new_dkp = await context.store.alliance_remove(member, event_type, amount, actor=str(interaction.user.id))
+        except InsufficientDKP as e:
+            await interaction.followup.send(f"You cannot remove more DKP than the clan has. Current DKP for event {event_type}: {e.balance}", ephemeral=True)
             return
 
-        dkp_data[member][event_type] = max(0, dkp_data[member][event_type] - amount)
-        save_data(alliance_dkp_data_file, dkp_data)
+        logger.info(f"{interaction.user.name} removed {amount} DKP from {member} clan. New DKP for event {event_type}: {new_dkp}")
 
-        logger.info(f"{interaction.user.name} removed {amount} DKP from {member} clan. New DKP for event {event_type}: {dkp_data[member][event_type]}")
-
-        await interaction.followup.send(
-            f"Removed {amount} DKP from {member} clan. Current DKP for event {event_type}: {dkp_data[member][event_type]}")
+        await announce(interaction,
+            f"Removed {amount} DKP from {member} clan. Current DKP for event {event_type}: {new_dkp}")
 
     @app_commands.command(name="dkp_alliance_show", description="Show the current DKP of a clan in the alliance.")
     @app_commands.describe(
         event_type="The event type to show DKP for.",
         member="The clan whose DKP to view."
     )
+    @instrument_command
     async def dkp_alliance_show(self, interaction: discord.Interaction, event_type: str, member: str):
         # Use defer to avoid timeout issues
         await interaction.response.defer()
 
-        if interaction.channel.id != ALLOWED_ALLIANCE_DKP_SHOW_CHANNEL_ID:
-            await interaction.followup.send("This command can only be used in the designated DKP channel.",
-                                                    ephemeral=True)
-            return
-
-        if not interaction.user.guild_permissions.administrator and not any(role.name == ALLIANCE_LEADER_ROLE for role in interaction.user.roles):
-            await interaction.followup.send("You do not have permission to use this command.", ephemeral=True)
+        context = await authorize(interaction, ALLIANCE_LEADER, ALLIANCE_SHOW_CHANNEL)
+        if context is None:
             return
 
-        if event_type not in ALLOWED_EVENTS_LIST:
+        if event_type not in context.config.events:
             await interaction.followup.send("Invalid event type selection.", ephemeral=True)
             return
 
-        if member not in ALLOWED_CLANS:
+        if member not in context.config.clans:
             await interaction.followup.send("Invalid clan selection.", ephemeral=True)
             return
 
-        dkp_data = load_data(alliance_dkp_data_file)
-
         member = member or "alliance"
-        current_member = dkp_data.get(member, {})
-        current_dkp = current_member.get(event_type, 0)
+        current_dkp = await context.store.alliance_points(member, event_type)
 
         await interaction.followup.send(
             f"{interaction.user.mention}, {member}'s current DKP for event {event_type} is: {current_dkp}")
 
+    @app_commands.command(name="dkp_alliance_bulk_add", description="Add DKP for one event to several clans in the alliance.")
+    @app_commands.describe(
+        event_type="The event type to add DKP to.",
+        clans="Comma-separated clans to add DKP to, or \"all\".",
+        amount="The amount of DKP to add to each clan."
+    )
+    @instrument_command
+    async def dkp_alliance_bulk_add(self, interaction: discord.Interaction, event_type: str, clans: str, amount: int):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer(ephemeral=True)
+
+        context = await authorize(interaction, "administrator", ALLIANCE_ADDREMOVE_CHANNEL, threads=True)
+        if context is None:
+            return
+
+        if event_type not in context.config.events:
+            await interaction.followup.send("Invalid event type selection.", ephemeral=True)
+            return
+
+        if clans.strip().lower() == "all":
+            selected = [clan for clan in context.config.clans if clan]
+        else:
+            selected = [clan.strip() for clan in clans.split(",") if clan.strip()]
+        invalid = [clan for clan in selected if clan not in context.config.clans]
+        if not selected or invalid:
+            await interaction.followup.send(f"Invalid clan selection: {', '.join(invalid) or clans}", ephemeral=True)
+            return
+
+        if amount < 0:
+            await interaction.followup.send("Amount must be a non-negative integer.", ephemeral=True)
+            return
+
+        # One batch record for every clan
+        points = await context.store.alliance_add_many(selected, event_type, amount, actor=str(interaction.user.id))
+
+        logger.info(f"{interaction.user.name} added {amount} DKP for event {event_type} to {len(points)} clan(s): {', '.join(points)}")
+
+        await announce(interaction,
+            f"Added {amount} DKP for event {event_type} to {len(points)} clan(s). Current DKP: "
+            + ", ".join(f"{clan} {points[clan]}" for clan in points)
+        )
+
+    @app_commands.command(name="dkp_alliance_board", description="Show the alliance DKP of every clan and event.")
+    @app_commands.describe(
+        event_type="Only rank the clans for this event (optional)."
+    )
+    @instrument_command
+    async def dkp_alliance_board(self, interaction: discord.Interaction, event_type: str = None):
+        # Use defer to avoid timeout issues
+        await interaction.response.defer()
+
+        context = await authorize(interaction, ALLIANCE_LEADER, ALLIANCE_SHOW_CHANNEL)
+        if context is None:
+            return
+
+        if event_type is not None and event_type not in context.config.events:
+            await interaction.followup.send("Invalid event type selection.", ephemeral=True)
+            return
+
+        board = await context.store.alliance_board()
+        if event_type is not None:
+            lines = [f"**Alliance DKP for event {event_type}:**"]
+            lines += [f"{idx}. {clan}: {points}" for idx, (clan, points) in enumerate(board.standings(event_type), start=1)]
+            lines.append(f"Total: {board.event_total(event_type)}")
+            await interaction.followup.send("\n".join(lines) if board.clans else "No alliance DKP yet.")
+            return
+
+        if not board.clans:
+            await interaction.followup.send("No alliance DKP yet.")
+            return
+
+        # Configured clans and events first, in their configured order
+        clans = [clan for clan in context.config.clans if clan in board.clans] + [clan for clan in board.clans if clan not in context.config.clans]
+        events = [event for event in context.config.events if event in board.events] + [event for event in board.events if event not in context.config.events]
+        header = ["Clan"] + events + ["Total"]
+        rows = [[clan] + [str(board.get(clan, event)) for event in events] + [str(board.clan_total(clan))] for clan in clans]
+        rows.append(["Total"] + [str(board.event_total(event)) for event in events] + [str(board.total)])
+        widths = [max(len(row[column]) for row in [header] + rows) for column in range(len(header))]
+        table = "\n".join(
+            "  ".join(cell.ljust(width) if column == 0 else cell.rjust(width) for column, (cell, width) in enumerate(zip(row, widths)))
+            for row in [header] + rows
+        )
+        standings = ", ".join(f"{idx}. {clan} {points}" for idx, (clan, points) in enumerate(board.standings(), start=1))
+
+        message = f"**Alliance DKP:**\n```\n{table}\n```\n{standings}"
+        if len(message) > 2000:
+            message = f"**Alliance DKP:**\n{standings}"[:2000]
+        await interaction.followup.send(message)
+
     @app_commands.command(name="dkp_trade", description="Trade my DKP to a guild member.")
     @app_commands.describe(
         member="The member to trade DKP to.",
         amount="The amount of DKP to trade."
     )
+    @instrument_command
     async def dkp_trade(self, interaction: discord.Interaction, member: discord.Member, amount: int):
         # Use defer to avoid timeout issues
-        await interaction.response.defer()
+        await interaction.response.defer(ephemeral=True)
 
-        if interaction.guild.id != GUILD_ID:
-            await interaction.followup.send("This command is not available in this guild.", ephemeral=True)
+        context = await authorize(interaction)
+        if context is None:
             return
 
-        if not any(role.name == MEMBER_ROLE for role in member.roles):
+        if not context.roles.has(member, MEMBER):
             await interaction.followup.send("Ціль передачі не є членом клану", ephemeral=True)
             return
 
@@ -557,63 +1083,121 @@ class DKPManager(commands.Cog):
             return
 
 
-        # Load current DKP and leaderboard data
-        dkp_data = load_data(dkp_data_file)
-
-        sender_id = str(interaction.user.id)
-        receiver_id = str(member.id)
-        if receiver_id not in dkp_data:
-            dkp_data[receiver_id] = 0
-
-        if amount > dkp_data[sender_id]:
-            await interaction.followup.send(f"Недостатньо DKP, маєш: {dkp_data[sender_id]}", ephemeral=True)
+        try:
+            await context.store.trade(str(interaction.user.id), str(member.id), amount)
+        except InsufficientDKP as e:
+            await interaction.followup.send(f"Недостатньо DKP, маєш: {e.balance}", ephemeral=True)
             return
 
-        dkp_data[sender_id] -= amount
-        dkp_data[receiver_id] = dkp_data.get(receiver_id, 0) + amount
-        save_data(dkp_data_file, dkp_data)
-
         logger.info(f"{interaction.user.name} traded {amount} DKP to {member.name}.")
 
-        await interaction.followup.send(
+        await announce(interaction,
             f"{interaction.user.mention} передав {amount} DKP до {member.mention}.")
 
     @dkp_alliance_add.autocomplete("member")
     @dkp_alliance_remove.autocomplete("member")
     @dkp_alliance_show.autocomplete("member")
-    async def member_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=clan, value=clan) for clan in ALLOWED_CLANS if current.lower() in clan.lower()]
+    async def clan_autocomplete(self, interaction: discord.Interaction, current: str):
+        context = guild_contexts.get(interaction.guild_id)
+        if context is None:
+            return []
+        return [app_commands.Choice(name=label, value=value) for label, value in context.clan_search.search(current)]
 
     @dkp_alliance_add.autocomplete("event_type")
     @dkp_alliance_remove.autocomplete("event_type")
     @dkp_alliance_show.autocomplete("event_type")
-    async def member_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=event_name, value=event_name) for event_name in ALLOWED_EVENTS_LIST if current.lower() in event_name.lower()]
-
-@bot.event
-async def on_ready():
-    logger.info(f"Logged in as {bot.user}!")
+    @dkp_alliance_bulk_add.autocomplete("event_type")
+    @dkp_alliance_board.autocomplete("event_type")
+    async def event_autocomplete(self, interaction: discord.Interaction, current: str):
+        context = guild_contexts.get(interaction.guild_id)
+        if context is None:
+            return []
+        return [app_commands.Choice(name=label, value=value) for label, value in context.event_search.search(current)]
+
+    @dkp_archive.autocomplete("member")
+    async def archive_autocomplete(self, interaction: discord.Interaction, current: str):
+        context = guild_contexts.get(interaction.guild_id)
+        # The archive is visible to administrators only, like /dkp_archive itself
+        if context is None or not permitted(context, interaction.user, "administrator"):
+            return []
+        entries = await context.archive_search.search(interaction.guild, current)
+        return [app_commands.Choice(name=label, value=value) for label, value in entries]
+
+# Fingerprint of the commands registered for a guild, as they are sent to
+# Discord when syncing
+def command_fingerprint(guild):
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)), key=lambda command: command["name"])
+    data = json.dumps({"application_id": bot.application_id, "commands": payload}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+# Sync the commands of the guilds whose fingerprint differs from the one
+# recorded in command_sync_file at their last sync. Syncing is slow and
+# tightly rate limited, so a restart with unchanged commands skips it.
+# Delete the file to force a sync.
+async def sync_commands():
     try:
-        # # Clear cached commands and sync
-        # await bot.tree.clear_commands(guild=discord.Object(id=GUILD_ID))
-        # logger.info("Cleared cached commands.")
-
-        # Load the cog
-        await setup()
-
-        await initialize_leaderboard()
+        synced, _ = load_data(command_sync_file)
+    except (OSError, ValueError):
+        synced = {}
 
-        # Sync the commands for the specific guild
-        guild = discord.Object(id=GUILD_ID)
-        synced = await bot.tree.sync(guild=guild)
+    for guild_id in guild_contexts:
+        guild = discord.Object(id=guild_id)
+        fingerprint = command_fingerprint(guild)
+        if synced.get(str(guild_id)) == fingerprint:
+            logger.info(f"Commands of the guild {guild_id} are unchanged, skipping sync.")
+            continue
 
-        logger.info(f"Synced {len(synced)} command(s) with the guild {GUILD_ID}.")
-        logger.info(f"Available commands: {[cmd.name for cmd in synced]}")
+        # # Clear cached commands and sync
+        # await bot.tree.clear_commands(guild=guild)
+        # logger.info("Cleared cached commands.")
+        commands_synced = await bot.tree.sync(guild=guild)
+        synced[str(guild_id)] = fingerprint
+        save_data(command_sync_file, synced)
+        logger.info(f"Synced {len(commands_synced)} command(s) with the guild {guild_id}: {[cmd.name for cmd in commands_synced]}")
+
+# Reconcile every guild's leaderboard with its members. One failing guild
+# does not stop the others.
+async def initialize_leaderboards():
+    for context in guild_contexts.values():
+        try:
+            await initialize_leaderboard(context)
+        except Exception:
+            logger.exception(f"Failed to reconcile the leaderboard of guild {context.guild_id}")
+
+reconcile_task = None
+
+# Runs once before the bot connects, unlike on_ready
+@bot.event
+async def setup_hook():
+    await setup()
+    try:
+        await sync_commands()
     except Exception as e:
         logger.error(f"Failed to sync commands: {e}")
 
+# on_ready fires again after every reconnect. Reconciliation runs in the
+# background, so commands are served while it catches up on role changes
+# missed while disconnected.
+@bot.event
+async def on_ready():
+    global reconcile_task
+    logger.info(f"Logged in as {bot.user}!")
+    if reconcile_task is None or reconcile_task.done():
+        reconcile_task = asyncio.ensure_future(initialize_leaderboards())
+
 async def setup():
+    if bot.get_cog("DKPManager") is not None:
+        return
     await bot.add_cog(DKPManager(bot))
     logger.info("DKPManager cog has been loaded.")
 
-bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    # Treat docker stop (SIGTERM) like Ctrl+C so the bot closes cleanly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    bot.run(DISCORD_TOKEN)
+
+    # Fold the ledgers into the snapshot files after the bot has shut down
+    for context in guild_contexts.values():
+        context.store.close()
+
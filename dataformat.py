@@ -0,0 +1,150 @@
+import argparse
+import json
+import re
+from itertools import islice
+
+# Optional fast serializers: msgpack for the binary compact format, orjson
+# for parsing and writing JSON. Both fall back to the standard library.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = "json"
+COMPACT = "compact"
+FORMATS = (JSON, COMPACT)
+
+# Binary compact files start with this header followed by a msgpack document
+MAGIC = b"DKPC\x01"
+# Without msgpack the columnar document is written as minified JSON tagged with this key
+COLUMNAR_KEY = "__dkp_columnar__"
+COLUMNAR_VERSION = 1
+
+MONTH_PATTERN = re.compile(r"^(\d{4})-(\d{2})$")
+
+
+# Member IDs are stored as integers when every ID round-trips exactly
+def _encode_ids(keys):
+    keys = list(keys)
+    if all(key.isdigit() for key in keys):
+        ids = list(map(int, keys))
+        if list(map(str, ids)) == keys:
+            return ids
+    return [_encode_id(key) for key in keys]
+
+def _encode_id(key):
+    if key.isdigit() and str(int(key)) == key:
+        return int(key)
+    return key
+
+def _month_index(key):
+    match = MONTH_PATTERN.match(key)
+    if match is None or not 1 <= int(match.group(2)) <= 12:
+        return None
+    return int(match.group(1)) * 12 + int(match.group(2)) - 1
+
+def _month_key(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+# Columnar layout of a data file. Flat maps (balances, archive) become an ID
+# column and a value column. Nested maps (monthly earnings, alliance points)
+# become ID and per-row entry counts plus flattened key and value columns,
+# with "YYYY-MM" keys stored as month offsets from the earliest month.
+def encode(data):
+    values = list(data.values())
+    if not any(isinstance(value, dict) for value in values):
+        return {"layout": "flat", "ids": _encode_ids(data), "values": values}
+
+    if not all(isinstance(value, dict) for value in values) or any(
+        isinstance(point, dict) for row in values for point in row.values()
+    ):
+        return {"layout": "raw", "data": data}
+
+    keys = [key for row in values for key in row]
+    # Only a handful of distinct months exist, so map each one once
+    months = {key: _month_index(key) for key in set(keys)}
+    base = min((month for month in months.values() if month is not None), default=None)
+    offsets = {key: key if month is None else month - base for key, month in months.items()}
+    return {
+        "layout": "nested",
+        "base": base,
+        "ids": _encode_ids(data),
+        "counts": [len(row) for row in values],
+        "keys": [offsets[key] for key in keys],
+        "values": [point for row in values for point in row.values()],
+    }
+
+def decode(payload):
+    layout = payload["layout"]
+    if layout == "flat":
+        return dict(zip(map(str, payload["ids"]), payload["values"]))
+    if layout == "raw":
+        return payload["data"]
+    if layout != "nested":
+        raise ValueError(f"Unknown columnar layout: {layout}")
+
+    base = payload["base"]
+    names = {key: key if isinstance(key, str) else _month_key(base + key) for key in set(payload["keys"])}
+    keys = iter([names[key] for key in payload["keys"]])
+    values = iter(payload["values"])
+    return {
+        member_id: dict(zip(islice(keys, count), islice(values, count)))
+        for member_id, count in zip(map(str, payload["ids"]), payload["counts"])
+    }
+
+
+def dumps(data, data_format=JSON):
+    if data_format == JSON:
+        return json.dumps(data, indent=4).encode()
+    if data_format != COMPACT:
+        raise ValueError(f"Unknown data format '{data_format}'. Use one of: {', '.join(FORMATS)}.")
+
+    payload = encode(data)
+    if msgpack is not None:
+        return MAGIC + msgpack.packb(payload)
+    payload[COLUMNAR_KEY] = COLUMNAR_VERSION
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+# Returns (data, data_format), detecting the format from the file contents
+def loads(raw):
+    if raw.startswith(MAGIC):
+        if msgpack is None:
+            raise RuntimeError("This data file uses the binary compact format. Install msgpack to read it.")
+        return decode(msgpack.unpackb(raw[len(MAGIC):], strict_map_key=False)), COMPACT
+
+    parsed = orjson.loads(raw) if orjson is not None else json.loads(raw.decode())
+    if isinstance(parsed, dict) and parsed.get(COLUMNAR_KEY) == COLUMNAR_VERSION:
+        return decode(parsed), COMPACT
+    return parsed, JSON
+
+
+# Convert data files between formats in place. Stop the bot first.
+def main():
+    from storage import load_data, save_data
+
+    parser = argparse.ArgumentParser(description="Convert DKP data files between the JSON and compact formats.")
+    parser.add_argument("format", choices=FORMATS, help="format to write")
+    parser.add_argument("files", nargs="+", help="data files to convert")
+    args = parser.parse_args()
+
+    for file in args.files:
+        data, data_format = load_data(file)
+        if data_format == args.format:
+            print(f"{file}: already {args.format}")
+            continue
+        if loads(dumps(data, args.format))[0] != data:
+            raise RuntimeError(f"{file}: converted data does not match the original, leaving it unchanged")
+        save_data(file, data, args.format)
+        print(f"{file}: {data_format} -> {args.format}")
+
+
+if __name__ == "__main__":
+    main()
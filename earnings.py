@@ -0,0 +1,179 @@
+from itertools import chain
+
+import numpy as np
+
+
+def month_index(month):
+    year, month_number = month.split("-")
+    return int(year) * 12 + int(month_number) - 1
+
+def month_key(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+# Monthly earnings as a member x month matrix over consecutive months, with
+# running sums along the month axis. The total for any span of months is the
+# difference of two cumulative columns, so range boards are a few vectorized
+# operations over the roster instead of a walk over every member's months.
+# A second pair of cumulative counts tracks which members have entries in a
+# span, matching the single-month boards that only list members with an entry.
+class EarningsMatrix:
+    def __init__(self, leaderboard_data=None):
+        self.rows = {}
+        self.member_ids = np.empty(0, dtype=object)
+        self.free_rows = []
+        self.first_month = None
+        self.points = np.zeros((0, 0), dtype=np.int64)
+        self.cumulative = np.zeros((0, 0), dtype=np.int64)
+        self.entries = np.zeros((0, 0), dtype=np.int32)
+        self.version = 0
+        self._ordering = None
+        if leaderboard_data:
+            self._build(leaderboard_data)
+
+    def _build(self, leaderboard_data):
+        rows_months = list(leaderboard_data.values())
+        self.rows = {member_id: row for row, member_id in enumerate(leaderboard_data)}
+        self.member_ids = np.array(list(leaderboard_data), dtype=object)
+        keys = [month for months in rows_months for month in months]
+        if not keys:
+            self.points = np.zeros((len(self.rows), 0), dtype=np.int64)
+            self.cumulative = self.points.copy()
+            self.entries = np.zeros(self.points.shape, dtype=np.int32)
+            return
+
+        counts = np.fromiter(map(len, rows_months), dtype=np.int64, count=len(rows_months))
+        rows = np.repeat(np.arange(len(rows_months)), counts)
+        indexes = {month: month_index(month) for month in set(keys)}
+        months = np.fromiter(map(indexes.__getitem__, keys), dtype=np.int64, count=len(keys))
+        points = np.fromiter(chain.from_iterable(row.values() for row in rows_months), dtype=np.int64, count=len(keys))
+        self.first_month = int(months.min())
+        self.points = np.zeros((len(self.rows), int(months.max()) - self.first_month + 1), dtype=np.int64)
+        self.points[rows, months - self.first_month] = points
+        present = np.zeros(self.points.shape, dtype=np.int32)
+        present[rows, months - self.first_month] = 1
+        self.cumulative = np.cumsum(self.points, axis=1)
+        self.entries = np.cumsum(present, axis=1, dtype=np.int32)
+
+    # Grow to at least the given rows and months, doubling the row capacity
+    def _resize(self, row_count, month_count, prepend=0):
+        capacity = self.points.shape[0]
+        if row_count > capacity:
+            capacity = max(row_count, capacity * 2, 16)
+        pad_rows = capacity - self.points.shape[0]
+        pad_months = month_count - self.points.shape[1] - prepend
+        if not pad_rows and not pad_months and not prepend:
+            return
+
+        self.points = np.pad(self.points, ((0, pad_rows), (prepend, pad_months)))
+        # Cumulative sums carry their last value into new months and start
+        # from zero in months prepended before the first one
+        self.cumulative = np.pad(self.cumulative, ((0, pad_rows), (prepend, 0)))
+        self.entries = np.pad(self.entries, ((0, pad_rows), (prepend, 0)))
+        if pad_months:
+            mode = "edge" if self.cumulative.shape[1] else "constant"
+            self.cumulative = np.pad(self.cumulative, ((0, 0), (0, pad_months)), mode=mode)
+            self.entries = np.pad(self.entries, ((0, 0), (0, pad_months)), mode=mode)
+        self.member_ids = np.concatenate([self.member_ids, np.empty(pad_rows, dtype=object)])
+
+    def _row(self, member_id):
+        row = self.rows.get(member_id)
+        if row is None:
+            row = self.free_rows.pop() if self.free_rows else len(self.rows)
+            self._resize(row + 1, self.points.shape[1])
+            self.rows[member_id] = row
+            self.member_ids[row] = member_id
+        return row
+
+    def _column(self, month):
+        index = month_index(month)
+        if self.first_month is None:
+            self.first_month = index
+        if index < self.first_month:
+            self._resize(self.points.shape[0], self.points.shape[1] + self.first_month - index, self.first_month - index)
+            self.first_month = index
+        elif index - self.first_month >= self.points.shape[1]:
+            self._resize(self.points.shape[0], index - self.first_month + 1)
+        return index - self.first_month
+
+    def set(self, member_id, month, points):
+        row = self._row(member_id)
+        column = self._column(month)
+        delta = points - self.points[row, column]
+        self.points[row, column] = points
+        self.cumulative[row, column:] += delta
+        if not self.entries[row, column] - (self.entries[row, column - 1] if column else 0):
+            self.entries[row, column:] += 1
+        self.version += 1
+
+    def discard(self, member_id):
+        row = self.rows.pop(member_id, None)
+        if row is None:
+            return
+        self.points[row] = 0
+        self.cumulative[row] = 0
+        self.entries[row] = 0
+        self.member_ids[row] = None
+        self.free_rows.append(row)
+        self.version += 1
+
+    # Drop the columns of every month up to and including month
+    def drop_through(self, month):
+        if self.first_month is None:
+            return
+        count = min(month_index(month) - self.first_month + 1, self.points.shape[1])
+        if count <= 0:
+            return
+        self.points = self.points[:, count:].copy()
+        self.cumulative = self.cumulative[:, count:] - self.cumulative[:, count - 1:count]
+        self.entries = self.entries[:, count:] - self.entries[:, count - 1:count]
+        self.first_month += count
+        self.version += 1
+
+    # Per-row totals and entry counts over the months first..last inclusive
+    def _totals(self, first, last):
+        low = max(month_index(first) - self.first_month, 0) if self.first_month is not None else 0
+        high = min(month_index(last) - self.first_month, self.points.shape[1] - 1) if self.first_month is not None else -1
+        if high < 0 or low > high:
+            rows = self.points.shape[0]
+            return np.zeros(rows, dtype=np.int64), np.zeros(rows, dtype=np.int32)
+
+        totals = self.cumulative[:, high].copy()
+        entries = self.entries[:, high].copy()
+        if low:
+            totals -= self.cumulative[:, low - 1]
+            entries -= self.entries[:, low - 1]
+        return totals, entries
+
+    # Members with entries in the range as (member_ids, totals), highest total
+    # first with ties broken by member ID. Cached until the next change.
+    def _ordered(self, first, last):
+        key = (first, last, self.version)
+        if self._ordering is not None and self._ordering[0] == key:
+            return self._ordering[1]
+
+        totals, entries = self._totals(first, last)
+        rows = np.flatnonzero(entries > 0)
+        member_ids = self.member_ids[rows].astype(str)
+        order = np.lexsort((member_ids, -totals[rows]))
+        self._ordering = (key, (member_ids[order], totals[rows][order]))
+        return self._ordering[1]
+
+    def top(self, first, last, limit=None, offset=0):
+        member_ids, totals = self._ordered(first, last)
+        stop = None if limit is None else offset + limit
+        return [(str(member_id), int(total)) for member_id, total in zip(member_ids[offset:stop], totals[offset:stop])]
+
+    def size(self, first, last):
+        return len(self._ordered(first, last)[0])
+
+    # (rank, points, ranked members) with competition ranking, or None
+    def rank(self, member_id, first, last):
+        row = self.rows.get(member_id)
+        if row is None:
+            return None
+        totals, entries = self._totals(first, last)
+        if not entries[row]:
+            return None
+        ranked = entries > 0
+        return int(np.count_nonzero(ranked & (totals > totals[row]))) + 1, int(totals[row]), int(np.count_nonzero(ranked))
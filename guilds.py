@@ -0,0 +1,94 @@
+import functools
+import json
+import os
+
+from autocomplete import ArchiveSearch, SearchIndex
+from pagination import PageCache
+from roles import RoleResolver, RoleChangeQueue, MEMBER, OFFICER, ALLIANCE_LEADER
+
+CHANNEL_SETTINGS = ("dkp_channel_id", "alliance_addremove_channel_id", "alliance_show_channel_id", "transfer_channel_id")
+ROLE_SETTINGS = ("member_role", "officer_role", "alliance_leader_role")
+LIST_SETTINGS = ("clans", "events")
+SETTINGS = CHANNEL_SETTINGS + ROLE_SETTINGS + LIST_SETTINGS + ("data_dir",)
+
+
+# Settings of one guild: the channels commands are limited to, the role
+# names, the alliance clans and events, and the directory its data lives in
+class GuildConfig:
+    def __init__(self, guild_id, data_dir, dkp_channel_id, alliance_addremove_channel_id, alliance_show_channel_id,
+                 transfer_channel_id, member_role, officer_role, alliance_leader_role, clans, events):
+        self.guild_id = guild_id
+        self.data_dir = data_dir
+        self.dkp_channel_id = dkp_channel_id
+        self.alliance_addremove_channel_id = alliance_addremove_channel_id
+        self.alliance_show_channel_id = alliance_show_channel_id
+        self.transfer_channel_id = transfer_channel_id
+        self.member_role = member_role
+        self.officer_role = officer_role
+        self.alliance_leader_role = alliance_leader_role
+        self.clans = clans
+        self.events = events
+
+
+def _split(value):
+    return value.split(",") if isinstance(value, str) else list(value)
+
+# Build every guild's config. defaults holds the settings from the
+# environment, including guild_id. Without a config file that guild is the
+# only one and keeps its data in the working directory as before. A config
+# file maps guild IDs to settings; whatever a guild leaves out comes from
+# defaults, and its data goes to guilds/<guild ID> unless it is the default
+# guild or sets data_dir.
+def load_guild_configs(file, defaults):
+    default_id = defaults.get("guild_id")
+    if file is None:
+        guilds = {str(default_id): {}}
+    else:
+        with open(file, "r") as f:
+            guilds = json.load(f)
+
+    configs = {}
+    for key, settings in guilds.items():
+        try:
+            guild_id = int(key)
+        except ValueError:
+            raise ValueError(f"{file}: guild ID '{key}' is not a number.")
+        unknown = set(settings) - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"{file}: unknown setting(s) for guild {guild_id}: {', '.join(sorted(unknown))}.")
+
+        values = {name: settings.get(name, defaults.get(name)) for name in SETTINGS}
+        if values["data_dir"] is None:
+            values["data_dir"] = "." if guild_id == default_id else os.path.join("guilds", str(guild_id))
+        for name in CHANNEL_SETTINGS:
+            try:
+                values[name] = int(values[name])
+            except (TypeError, ValueError):
+                raise ValueError(f"Guild {guild_id}: {name} is not set or invalid. Please check the .env file and {file or 'GUILDS_CONFIG'}.")
+        for name in LIST_SETTINGS:
+            values[name] = _split(values[name] or "")
+        configs[guild_id] = GuildConfig(guild_id, **values)
+    return configs
+
+
+# Everything the bot keeps per guild: its settings, its own store (and with
+# it its own files, writer thread and locks), its leaderboard pages, resolved
+# roles, queued role changes and autocomplete indexes. Guilds share none of it, so traffic in one
+# guild never waits on another guild's files or locks.
+# apply_role_changes(context, joined, left) applies a window of role changes.
+class GuildContext:
+    def __init__(self, config, store, page_size, role_update_window, apply_role_changes):
+        self.config = config
+        self.store = store
+        self.page_cache = PageCache(store, page_size)
+        self.roles = RoleResolver({
+            MEMBER: config.member_role, OFFICER: config.officer_role, ALLIANCE_LEADER: config.alliance_leader_role,
+        })
+        self.role_changes = RoleChangeQueue(functools.partial(apply_role_changes, self), role_update_window)
+        self.clan_search = SearchIndex(((clan, clan) for clan in config.clans if clan), substrings=True)
+        self.event_search = SearchIndex(((event, event) for event in config.events if event), substrings=True)
+        self.archive_search = ArchiveSearch(store)
+
+    @property
+    def guild_id(self):
+        return self.config.guild_id
@@ -0,0 +1,170 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            idx = len(BUCKETS)
+        self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+    # Upper bound of the bucket holding the q-th quantile
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[idx] if idx < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+# Process-wide counters, gauges and latency histograms. Updates may come from
+# the storage writer thread, so every change goes through one lock.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, _label_key(labels)), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, _label_key(labels)))
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (series_name, key), value in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"{name}{_format_labels(key)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, key), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, file):
+        tmp_file = f"{file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_file, file)
+
+    # Minimal HTTP endpoint answering every request with the current metrics
+    async def serve(self, host, port):
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+metrics = Metrics()
+
+
+# Wrap an app command callback to record its latency and whether the
+# interaction was deferred or failed. Apply it directly above the def so the
+# app_commands decorators still see the original signature.
+def instrument_command(func):
+    @functools.wraps(func)
+    async def wrapper(self, interaction, *args, **kwargs):
+        command = func.__name__
+        started = time.perf_counter()
+        try:
+            result = await func(self, interaction, *args, **kwargs)
+        except Exception:
+            metrics.inc("dkp_interactions_total", command=command, outcome="failed")
+            raise
+        else:
+            outcome = "deferred" if interaction.response.is_done() else "completed"
+            metrics.inc("dkp_interactions_total", command=command, outcome=outcome)
+            return result
+        finally:
+            metrics.observe("dkp_command_duration_seconds", time.perf_counter() - started, command=command)
+
+    return wrapper
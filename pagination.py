@@ -0,0 +1,126 @@
+from datetime import datetime
+
+import discord
+from discord.ui import View, Button, TextInput, Modal
+
+
+# Rendered leaderboard, archive and history pages. Entries are tagged with
+# the store version they were rendered at, so page flips and repeated views
+# are served from memory until a DKP mutation bumps the version.
+class PageCache:
+    def __init__(self, store, page_size=20):
+        self.store = store
+        self.page_size = page_size
+        self.pages = {}
+
+    # months is None for the overall board or a (first, last) pair of months
+    async def leaderboard(self, months, title, page):
+        if months is None:
+            count = self.store.board_size
+            fetch = self.store.top_balances
+        else:
+            count = lambda: self.store.range_size(*months)
+            fetch = lambda limit, offset: self.store.top_range(*months, limit, offset)
+
+        return await self._render(
+            ("leaderboard", months, title), page, f"**{title} DKP Leaderboard:**", count, fetch,
+            lambda position, member_id, dkp: f"{position}. <@{member_id}>: {dkp}",
+        )
+
+    async def archive(self, page):
+        return await self._render(
+            ("archive",), page, "**DKP Archive:**", self.store.archive_size, self.store.archived_members,
+            lambda position, member_id, dkp: f"<@{member_id}>: {dkp}",
+        )
+
+    # A member's history between the since and until timestamps, newest first
+    async def history(self, member_id, since, until, page):
+        return await self._render(
+            ("history", member_id, since, until), page, f"**DKP history of <@{member_id}>:**",
+            lambda: self.store.history_size(member_id, since, until),
+            lambda limit, offset: self.store.member_history(member_id, since, until, limit, offset),
+            history_line,
+        )
+
+    # Returns (content, page_count) with page clamped to the available pages
+    async def _render(self, key, page, header, count, fetch, line):
+        version = self.store.version
+        cached = self.pages.get(key + (page,))
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        page_count = max(1, -(-await count() // self.page_size))
+        page = min(max(page, 0), page_count - 1)
+        offset = page * self.page_size
+        rows = await fetch(self.page_size, offset)
+        lines = [line(offset + idx + 1, *row) for idx, row in enumerate(rows)]
+        suffix = f" (page {page + 1}/{page_count})" if page_count > 1 else ""
+        content = header + suffix + "\n" + "\n".join(lines)
+
+        if self.store.version == version:
+            if any(entry[0] != version for entry in self.pages.values()):
+                self.pages.clear()
+            self.pages[key + (page,)] = (version, content, page_count)
+        return content, page_count
+
+
+def history_line(position, ts, actor, member_id, amount, balance, kind):
+    when = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+    by = f" by <@{actor}>" if actor is not None and actor != member_id else ""
+    return f"`{when}` {kind} {amount:+d} → {balance}{by}"
+
+
+class JumpToPageModal(Modal, title="Jump to page"):
+    page_number = TextInput(label="Page number", max_length=6)
+
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            page = int(self.page_number.value) - 1
+        except ValueError:
+            await interaction.response.send_message("Page number must be an integer.", ephemeral=True)
+            return
+        await self.view.show(interaction, page)
+
+
+# Previous/next/jump navigation for a paged message. Only the member who ran
+# the command can flip its pages.
+class PageView(View):
+    def __init__(self, author_id, render, page_count, timeout=300):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.render = render
+        self.page = 0
+        self.page_count = page_count
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Only the member who ran this command can change pages.", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction: discord.Interaction, page):
+        content, self.page_count = await self.render(page)
+        self.page = min(max(page, 0), self.page_count - 1)
+        self._update_buttons()
+        await interaction.response.edit_message(content=content, view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: Button):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(label="Jump to page", style=discord.ButtonStyle.primary)
+    async def jump_to_page(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.send_modal(JumpToPageModal(self))
@@ -0,0 +1,53 @@
+from sortedcontainers import SortedList
+
+
+# Members ordered by points, highest first, ties broken by member ID. Updates,
+# rank lookups and the start of a top-N slice are O(log n).
+class RankedIndex:
+    def __init__(self, items=()):
+        self.points = dict(items)
+        self.order = SortedList((-points, member_id) for member_id, points in self.points.items())
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, member_id):
+        return member_id in self.points
+
+    def get(self, member_id, default=None):
+        return self.points.get(member_id, default)
+
+    def set(self, member_id, points):
+        old_points = self.points.get(member_id)
+        if old_points == points:
+            return
+        if old_points is not None:
+            self.order.remove((-old_points, member_id))
+        self.points[member_id] = points
+        self.order.add((-points, member_id))
+
+    # Set many members at once, re-sorting everything when most of them change
+    def update(self, items):
+        items = list(items)
+        if len(items) * 4 < len(self.points):
+            for member_id, points in items:
+                self.set(member_id, points)
+            return
+        self.points.update(items)
+        self.order = SortedList((-points, member_id) for member_id, points in self.points.items())
+
+    def discard(self, member_id):
+        old_points = self.points.pop(member_id, None)
+        if old_points is not None:
+            self.order.remove((-old_points, member_id))
+
+    def top(self, limit=None, offset=0):
+        stop = None if limit is None else offset + limit
+        return [(member_id, -points) for points, member_id in self.order.islice(offset, stop)]
+
+    # 1-based competition rank: members with equal points share a rank
+    def rank(self, member_id):
+        points = self.points.get(member_id)
+        if points is None:
+            return None
+        return self.order.bisect_left((-points, "")) + 1
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MEMBER = "member"
+OFFICER = "officer"
+ALLIANCE_LEADER = "alliance_leader"
+
+
+# Configured role names resolved to the IDs of the guild roles carrying them,
+# so checking a member is a few ID lookups instead of comparing the name of
+# every role they have. Resolved lazily per guild and refreshed whenever the
+# guild's roles are created, renamed or deleted.
+class RoleResolver:
+    def __init__(self, names):
+        self.names = names
+        self.guild_id = None
+        self.ids = {key: frozenset() for key in names}
+
+    def refresh(self, guild):
+        ids = {key: set() for key in self.names}
+        for role in guild.roles:
+            for key, name in self.names.items():
+                if role.name == name:
+                    ids[key].add(role.id)
+        self.ids = {key: frozenset(role_ids) for key, role_ids in ids.items()}
+        self.guild_id = guild.id
+
+    def resolve(self, guild):
+        if guild is not None and guild.id != self.guild_id:
+            self.refresh(guild)
+
+    def has(self, member, key):
+        return any(member.get_role(role_id) is not None for role_id in self.ids[key])
+
+
+# Member role changes collected over a short window and applied together, so
+# a burst of role assignments costs one store update instead of one per
+# member. Only each member's latest state counts, and a member who ends the
+# window where they started it is dropped, so toggles cancel out.
+# apply(joined, left) receives the member IDs that gained and lost the role.
+class RoleChangeQueue:
+    def __init__(self, apply, window):
+        self.apply = apply
+        self.window = window
+        self.pending = {}
+        self.task = None
+
+    def push(self, member_id, was_member, is_member):
+        started = self.pending[member_id][0] if member_id in self.pending else was_member
+        if started == is_member:
+            self.pending.pop(member_id, None)
+        else:
+            self.pending[member_id] = (started, is_member)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        while self.pending:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to apply queued role changes")
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        joined = [member_id for member_id, (_, is_member) in pending.items() if is_member]
+        left = [member_id for member_id, (_, is_member) in pending.items() if not is_member]
+        await self.apply(joined, left)
@@ -0,0 +1,394 @@
+import logging
+import os
+import sqlite3
+
+from alliance import AllianceMatrix
+from metrics import metrics
+from storage import DKPStore
+from transactions import record_entries
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (
+    member_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL
+);
+-- Ties are broken by member ID, as on the JSON backend, so pages are stable
+DROP INDEX IF EXISTS balances_by_balance;
+CREATE INDEX IF NOT EXISTS balances_by_rank ON balances (balance DESC, member_id);
+
+CREATE TABLE IF NOT EXISTS earnings (
+    member_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (member_id, month)
+);
+DROP INDEX IF EXISTS earnings_by_month;
+CREATE INDEX IF NOT EXISTS earnings_by_rank ON earnings (month, points DESC, member_id);
+
+CREATE TABLE IF NOT EXISTS archive (
+    member_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    ts INTEGER NOT NULL,
+    actor TEXT,
+    member_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_by_member ON transactions (member_id, ts);
+CREATE INDEX IF NOT EXISTS transactions_by_time ON transactions (ts);
+
+CREATE TABLE IF NOT EXISTS alliance (
+    clan TEXT NOT NULL,
+    event TEXT NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (clan, event)
+);
+"""
+
+
+def _limit_clause(limit, offset):
+    # SQLite needs a LIMIT before an OFFSET, -1 means no limit
+    return " LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset)
+
+
+# DKP data in an indexed SQLite database. Each ledger record is applied as one
+# transaction touching only the rows of the members involved, and leaderboards
+# are answered by index-ordered queries instead of sorting the whole roster.
+# The connection is only used from the store's writer thread once the bot runs.
+# The small alliance table is mirrored in an AllianceMatrix on the event loop.
+class SqliteStore(DKPStore):
+    def __init__(self, db_file):
+        super().__init__()
+        self.db_file = db_file
+        self.db = None
+        self.alliance = AllianceMatrix()
+
+    def load(self):
+        self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.load_alliance()
+        self.clock = self._scalar("SELECT MAX(ts) FROM transactions", (), 0) or 0
+        members = self.db.execute("SELECT COUNT(*) FROM balances").fetchone()[0]
+        archived = self.db.execute("SELECT COUNT(*) FROM archive").fetchone()[0]
+        logger.info(f"Loaded DKP database {self.db_file}: {members} members, {archived} archived.")
+
+    def load_alliance(self):
+        self.alliance = AllianceMatrix()
+        for clan, event, points in self.db.execute("SELECT clan, event, points FROM alliance"):
+            self.alliance.set(clan, event, points)
+
+    def close(self):
+        if self.db is None:
+            return
+        super().close()
+        self.db.close()
+        self.db = None
+
+    async def flush(self):
+        metrics.set("dkp_file_size_bytes", os.path.getsize(self.db_file), file=os.path.normpath(self.db_file))
+
+    async def _persist(self, record):
+        await self._run(self._write, record)
+        self._mirror(record)
+        self.version += 1
+
+    def _mirror(self, record):
+        if record["op"] == "batch":
+            for item in record["records"]:
+                self._mirror(item)
+        elif record["op"] in ("alliance_add", "alliance_remove"):
+            self.alliance.set(record["clan"], record["event"], record["points"])
+
+    def _write(self, record):
+        with self.db:
+            self._apply(record)
+            self.db.executemany(
+                "INSERT INTO transactions (ts, actor, member_id, amount, balance, kind) VALUES (?, ?, ?, ?, ?, ?)",
+                record_entries(record),
+            )
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "batch":
+            for item in record["records"]:
+                self._apply(item)
+        elif op in ("add", "remove", "cancel", "track"):
+            member_id = record["member"]
+            self._set_balance(member_id, record["balance"])
+            if op == "track":
+                self.db.execute("DELETE FROM archive WHERE member_id = ?", (member_id,))
+                self.db.execute(
+                    "INSERT OR IGNORE INTO earnings (member_id, month, points) VALUES (?, ?, 0)",
+                    (member_id, record["month"]),
+                )
+            elif "month" in record:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO earnings (member_id, month, points) VALUES (?, ?, ?)",
+                    (member_id, record["month"], record["month_total"]),
+                )
+        elif op == "trade":
+            self._set_balance(record["sender"], record["sender_balance"])
+            self._set_balance(record["receiver"], record["receiver_balance"])
+        elif op == "archive":
+            member_id = record["member"]
+            self.db.execute("DELETE FROM balances WHERE member_id = ?", (member_id,))
+            self.db.execute("DELETE FROM earnings WHERE member_id = ?", (member_id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO archive (member_id, balance) VALUES (?, ?)",
+                (member_id, record["balance"]),
+            )
+        elif op in ("alliance_add", "alliance_remove"):
+            self.db.execute(
+                "INSERT OR REPLACE INTO alliance (clan, event, points) VALUES (?, ?, ?)",
+                (record["clan"], record["event"], record["points"]),
+            )
+        elif op == "decay":
+            self.db.executemany(
+                "UPDATE balances SET balance = ? WHERE member_id = ?",
+                zip(record["balances"], record["members"]),
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_decay', ?)", (record["period"],))
+        else:
+            raise ValueError(f"Unknown ledger operation: {op}")
+
+    def _set_balance(self, member_id, balance):
+        self.db.execute(
+            "INSERT OR REPLACE INTO balances (member_id, balance) VALUES (?, ?)",
+            (member_id, balance),
+        )
+
+    def _scalar(self, query, params, default=None):
+        row = self.db.execute(query, params).fetchone()
+        return default if row is None else row[0]
+
+    def _fetchall(self, query, params=()):
+        return self.db.execute(query, params).fetchall()
+
+    # Reads
+    async def balance(self, member_id):
+        return await self._run(self._scalar, "SELECT balance FROM balances WHERE member_id = ?", (member_id,), 0)
+
+    async def month_total(self, member_id, month):
+        return await self._run(
+            self._scalar, "SELECT points FROM earnings WHERE member_id = ? AND month = ?", (member_id, month), 0
+        )
+
+    async def archived_balance(self, member_id):
+        return await self._run(self._scalar, "SELECT balance FROM archive WHERE member_id = ?", (member_id,))
+
+    async def alliance_board(self):
+        return self.alliance
+
+    async def alliance_points(self, clan, event_type):
+        return await self._run(
+            self._scalar, "SELECT points FROM alliance WHERE clan = ? AND event = ?", (clan, event_type), 0
+        )
+
+    async def top_balances(self, limit=None, offset=0):
+        clause, params = _limit_clause(limit, offset)
+        return await self._run(
+            self._fetchall, "SELECT member_id, balance FROM balances ORDER BY balance DESC, member_id" + clause, params
+        )
+
+    async def top_month(self, month, limit=None, offset=0):
+        clause, params = _limit_clause(limit, offset)
+        return await self._run(
+            self._fetchall,
+            "SELECT member_id, points FROM earnings WHERE month = ? ORDER BY points DESC, member_id" + clause,
+            (month,) + params,
+        )
+
+    async def top_range(self, first, last, limit=None, offset=0):
+        if first == last:
+            return await self.top_month(first, limit, offset)
+        clause, params = _limit_clause(limit, offset)
+        return await self._run(
+            self._fetchall,
+            "SELECT member_id, SUM(points) AS total FROM earnings WHERE month BETWEEN ? AND ?"
+            " GROUP BY member_id ORDER BY total DESC, member_id" + clause,
+            (first, last) + params,
+        )
+
+    async def range_size(self, first, last):
+        if first == last:
+            return await self.board_size(first)
+        return await self._run(
+            self._scalar, "SELECT COUNT(DISTINCT member_id) FROM earnings WHERE month BETWEEN ? AND ?", (first, last)
+        )
+
+    async def range_rank(self, member_id, first, last):
+        if first == last:
+            return await self.rank(member_id, first)
+        return await self._run(self._range_rank, member_id, first, last)
+
+    def _range_rank(self, member_id, first, last):
+        points = self._scalar(
+            "SELECT SUM(points) FROM earnings WHERE member_id = ? AND month BETWEEN ? AND ?", (member_id, first, last)
+        )
+        if points is None:
+            return None
+        above, total = self.db.execute(
+            "SELECT COUNT(CASE WHEN total > ? THEN 1 END), COUNT(*) FROM"
+            " (SELECT SUM(points) AS total FROM earnings WHERE month BETWEEN ? AND ? GROUP BY member_id)",
+            (points, first, last),
+        ).fetchone()
+        return above + 1, points, total
+
+    async def archived_members(self, limit=None, offset=0):
+        clause, params = _limit_clause(limit, offset)
+        return await self._run(
+            self._fetchall, "SELECT member_id, balance FROM archive ORDER BY rowid" + clause, params
+        )
+
+    async def board_size(self, month=None):
+        if month is None:
+            return await self._run(self._scalar, "SELECT COUNT(*) FROM balances", ())
+        return await self._run(self._scalar, "SELECT COUNT(*) FROM earnings WHERE month = ?", (month,))
+
+    async def archive_size(self):
+        return await self._run(self._scalar, "SELECT COUNT(*) FROM archive", ())
+
+    async def rank(self, member_id, month=None):
+        return await self._run(self._rank, member_id, month)
+
+    def _rank(self, member_id, month):
+        # Counting the rows above a member walks the points index, the board
+        # itself is never built
+        if month is None:
+            points = self._scalar("SELECT balance FROM balances WHERE member_id = ?", (member_id,))
+            if points is None:
+                return None
+            above = self._scalar("SELECT COUNT(*) FROM balances WHERE balance > ?", (points,))
+            total = self._scalar("SELECT COUNT(*) FROM balances", ())
+        else:
+            points = self._scalar(
+                "SELECT points FROM earnings WHERE member_id = ? AND month = ?", (member_id, month)
+            )
+            if points is None:
+                return None
+            above = self._scalar("SELECT COUNT(*) FROM earnings WHERE month = ? AND points > ?", (month, points))
+            total = self._scalar("SELECT COUNT(*) FROM earnings WHERE month = ?", (month,))
+        return above + 1, points, total
+
+    async def roster(self, member_ids=None):
+        return await self._run(self._roster, member_ids)
+
+    def _roster(self, member_ids=None):
+        if member_ids is None:
+            tracked = dict(self._fetchall("SELECT member_id, balance FROM balances"))
+            archived = dict(self._fetchall("SELECT member_id, balance FROM archive"))
+            return tracked, archived
+
+        # Look the members up in chunks that stay under SQLite's parameter limit
+        tracked, archived = {}, {}
+        member_ids = list(member_ids)
+        for start in range(0, len(member_ids), 500):
+            chunk = member_ids[start:start + 500]
+            marks = ", ".join("?" * len(chunk))
+            tracked.update(self._fetchall(f"SELECT member_id, balance FROM balances WHERE member_id IN ({marks})", chunk))
+            archived.update(self._fetchall(f"SELECT member_id, balance FROM archive WHERE member_id IN ({marks})", chunk))
+        return tracked, archived
+
+    async def last_decay(self):
+        return await self._run(self._scalar, "SELECT value FROM meta WHERE key = 'last_decay'", ())
+
+    def _history_filter(self, since, until):
+        return " AND ts >= ? AND ts <= ?", (-1 if since is None else since, 2 ** 62 if until is None else until)
+
+    async def member_history(self, member_id, since=None, until=None, limit=None, offset=0):
+        where, params = self._history_filter(since, until)
+        limit_clause, limit_params = _limit_clause(limit, offset)
+        return await self._run(
+            self._fetchall,
+            "SELECT ts, actor, member_id, amount, balance, kind FROM transactions WHERE member_id = ?"
+            + where + " ORDER BY ts DESC, rowid DESC" + limit_clause,
+            (member_id,) + params + limit_params,
+        )
+
+    async def history_size(self, member_id, since=None, until=None):
+        where, params = self._history_filter(since, until)
+        return await self._run(self._scalar, "SELECT COUNT(*) FROM transactions WHERE member_id = ?" + where, (member_id,) + params)
+
+    # Pages through the time index, resuming after the last (ts, rowid) seen
+    async def export_history(self, since=None, until=None, chunk_size=5000):
+        low, high = self._history_filter(since, until)[1]
+        after = (low - 1, 0)
+        while True:
+            rows = await self._run(
+                self._fetchall,
+                "SELECT rowid, ts, actor, member_id, amount, balance, kind FROM transactions"
+                " WHERE (ts > ? OR (ts = ? AND rowid > ?)) AND ts <= ? ORDER BY ts, rowid LIMIT ?",
+                (after[0], after[0], after[1], high, chunk_size),
+            )
+            if not rows:
+                break
+            after = (rows[-1][1], rows[-1][0])
+            yield [row[1:] for row in rows]
+
+    async def rollover(self, hot_months, month=None):
+        # Earnings are indexed by month and read from disk per query, so old
+        # months never enter the working set and nothing has to move
+        return []
+
+
+# One-shot import of the JSON data files, the leaderboard history files and
+# any pending ledger records into a fresh SQLite database
+def migrate_json_to_sqlite(json_store, sqlite_store):
+    json_store.load()
+    with sqlite_store.db:
+        sqlite_store.db.executemany(
+            "INSERT OR REPLACE INTO balances (member_id, balance) VALUES (?, ?)",
+            json_store.dkp_data.items(),
+        )
+        # Months that rolled over to the history files first, so the resident
+        # months win where both hold one
+        for month in sorted(json_store.history.months):
+            sqlite_store.db.executemany(
+                "INSERT OR REPLACE INTO earnings (member_id, month, points) VALUES (?, ?, ?)",
+                ((member_id, month, points) for member_id, points in json_store.history.ranking(month).items()),
+            )
+        sqlite_store.db.executemany(
+            "INSERT OR REPLACE INTO earnings (member_id, month, points) VALUES (?, ?, ?)",
+            (
+                (member_id, month, points)
+                for member_id, months in json_store.leaderboard_data.items()
+                for month, points in months.items()
+            ),
+        )
+        sqlite_store.db.executemany(
+            "INSERT OR REPLACE INTO archive (member_id, balance) VALUES (?, ?)",
+            json_store.archive_data.items(),
+        )
+        sqlite_store.db.executemany(
+            "INSERT OR REPLACE INTO alliance (clan, event, points) VALUES (?, ?, ?)",
+            (
+                (clan, event, points)
+                for clan, events in json_store.alliance_data.items()
+                for event, points in events.items()
+            ),
+        )
+        sqlite_store.db.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            json_store.meta_data.items(),
+        )
+        sqlite_store.db.executemany(
+            "INSERT INTO transactions (ts, actor, member_id, amount, balance, kind) VALUES (?, ?, ?, ?, ?, ?)",
+            json_store.transactions.scan(),
+        )
+    sqlite_store.load_alliance()
+    sqlite_store.clock = max(sqlite_store.clock, json_store.clock)
+    json_store.close()
+    logger.info(f"Migrated {len(json_store.dkp_data)} members and {len(json_store.archive_data)} archived members into {sqlite_store.db_file}.")
@@ -0,0 +1,892 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
+
+import dataformat
+from alliance import AllianceMatrix
+from earnings import EarningsMatrix, month_index, month_key
+from metrics import metrics
+from ranking import RankedIndex
+from transactions import TransactionLog, record_entries
+
+logger = logging.getLogger(__name__)
+
+DKP = "dkp"
+LEADERBOARD = "leaderboard"
+ARCHIVE = "archive"
+ALLIANCE = "alliance"
+META = "meta"
+
+
+# Load and save data. load_data() detects the file format and returns it
+# along with the data.
+def load_data(file):
+    name = os.path.normpath(file)
+    with metrics.timed("dkp_file_read_seconds", file=name):
+        with open(file, "rb") as f:
+            data, data_format = dataformat.loads(f.read())
+    size = os.path.getsize(file)
+    metrics.inc("dkp_file_read_bytes_total", size, file=name)
+    metrics.set("dkp_file_size_bytes", size, file=name)
+    return data, data_format
+
+def save_data(file, data, data_format=dataformat.JSON):
+    name = os.path.normpath(file)
+    # Write to a temporary file first so a crash never leaves a truncated snapshot
+    tmp_file = f"{file}.tmp"
+    with metrics.timed("dkp_file_write_seconds", file=name):
+        with open(tmp_file, "wb") as f:
+            f.write(dataformat.dumps(data, data_format))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
+    size = os.path.getsize(file)
+    metrics.inc("dkp_file_written_bytes_total", size, file=name)
+    metrics.set("dkp_file_size_bytes", size, file=name)
+
+def current_month():
+    return datetime.now().strftime("%Y-%m")
+
+# Balances after one decay step: each balance above the floor loses percent of
+# itself, rounded down, but never drops below the floor
+def decay_balances(balances, percent, floor):
+    decayed = balances - np.floor(balances * (percent / 100)).astype(np.int64)
+    return np.where(balances > floor, np.maximum(decayed, floor), balances)
+
+# Whether a ledger record archives or restores any member
+def _changes_archive(record):
+    if record["op"] == "batch":
+        return any(_changes_archive(item) for item in record["records"])
+    return record["op"] in ("track", "archive")
+
+def _log_write_failure(future):
+    if future.exception() is not None:
+        logger.error(f"Background DKP write failed: {future.exception()!r}")
+
+
+# Raised when a removal or trade would take more DKP than is available
+class InsufficientDKP(Exception):
+    def __init__(self, balance):
+        super().__init__(f"Insufficient DKP: {balance}")
+        self.balance = balance
+
+
+# One asyncio lock per key (member ID or alliance cell), created on demand and
+# dropped once nobody holds or waits on it. Keys are always acquired in sorted
+# order so multi-key holders such as trades cannot deadlock. hold_all() locks
+# every key at once for roster-wide changes: it waits for current holders to
+# finish and keeps new ones out, without creating a lock per member.
+class KeyedLocks:
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+        self.holders = 0
+        self.exclusive = None
+        self.idle = None
+
+    def _lock(self, key):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        while self.exclusive is not None and self.exclusive.locked():
+            async with self.exclusive:
+                pass
+        self.holders += 1
+        locks = [self._lock(key) for key in sorted(set(keys))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            self.holders -= 1
+            if not self.holders and self.idle is not None:
+                self.idle.set()
+
+    @contextlib.asynccontextmanager
+    async def hold_all(self):
+        # Created lazily so they bind to the running event loop
+        if self.exclusive is None:
+            self.exclusive = asyncio.Lock()
+        async with self.exclusive:
+            while self.holders:
+                self.idle = asyncio.Event()
+                await self.idle.wait()
+            self.idle = None
+            yield
+
+
+# Storage interface used by the bot. Mutations are turned into ledger records
+# holding the resulting values and handed to _commit(), which stamps them with
+# the time and the acting user; backends implement the reads, the leaderboard
+# and history queries and how records are persisted. Disk work runs
+# on a single writer thread so it never blocks the event loop and writes are
+# applied in the order they were committed. Each mutation holds the locks of
+# the members it touches from its first read to its commit, so concurrent
+# commands on the same member are serialized while others run in parallel.
+# version is bumped by every commit so callers can cache derived views, and
+# archive_version by every commit that archives or restores members.
+class DKPStore:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+        self.locks = KeyedLocks()
+        self.version = 0
+        self.archive_version = 0
+        self.clock = 0
+
+    # load() and close() run outside the event loop, at startup and shutdown
+    def load(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def flush(self):
+        pass
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # Includes the time spent queued behind other writer-thread work
+        with metrics.timed("dkp_storage_call_seconds", call=func.__name__):
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _submit(self, func, *args):
+        # Fire-and-forget write; failures are logged since nobody awaits them
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(_log_write_failure)
+
+    # Timestamps never go backwards, so history stays in time order even if
+    # the system clock is set back
+    async def _commit(self, record, actor=None):
+        self.clock = max(self.clock, int(time.time()))
+        record["ts"] = self.clock
+        record["actor"] = actor
+        await self._persist(record)
+        if _changes_archive(record):
+            self.archive_version += 1
+
+    async def _persist(self, record):
+        raise NotImplementedError
+
+    # Reads
+    async def balance(self, member_id):
+        raise NotImplementedError
+
+    async def month_total(self, member_id, month):
+        raise NotImplementedError
+
+    async def archived_balance(self, member_id):
+        raise NotImplementedError
+
+    async def alliance_points(self, clan, event_type):
+        raise NotImplementedError
+
+    # The alliance points as an AllianceMatrix with clan and event totals.
+    # Callers must treat it as read-only.
+    async def alliance_board(self):
+        raise NotImplementedError
+
+    # Leaderboards as (member_id, points) lists, highest first
+    async def top_balances(self, limit=None, offset=0):
+        raise NotImplementedError
+
+    async def top_month(self, month, limit=None, offset=0):
+        raise NotImplementedError
+
+    async def archived_members(self, limit=None, offset=0):
+        raise NotImplementedError
+
+    # Boards summing the months first..last inclusive ("YYYY-MM"), listing
+    # members with an entry in any of those months
+    async def top_range(self, first, last, limit=None, offset=0):
+        raise NotImplementedError
+
+    async def range_size(self, first, last):
+        raise NotImplementedError
+
+    async def range_rank(self, member_id, first, last):
+        raise NotImplementedError
+
+    # Number of members on the overall board or on a month's board
+    async def board_size(self, month=None):
+        raise NotImplementedError
+
+    async def archive_size(self):
+        raise NotImplementedError
+
+    # (rank, points, ranked members) of a member on the overall board or on a
+    # month's board, or None when the member is not on it
+    async def rank(self, member_id, month=None):
+        raise NotImplementedError
+
+    # Tracked and archived members as two {member_id: balance} dicts, limited
+    # to the given member IDs when there are any
+    async def roster(self, member_ids=None):
+        raise NotImplementedError
+
+    # Period key of the last decay applied, or None
+    async def last_decay(self):
+        raise NotImplementedError
+
+    # A member's history entries (ts, actor, member_id, amount, balance, kind)
+    # with since <= ts <= until, newest first
+    async def member_history(self, member_id, since=None, until=None, limit=None, offset=0):
+        raise NotImplementedError
+
+    async def history_size(self, member_id, since=None, until=None):
+        raise NotImplementedError
+
+    # Every member's history entries with since <= ts <= until in time order,
+    # yielded as lists of up to chunk_size entries
+    async def export_history(self, since=None, until=None, chunk_size=5000):
+        raise NotImplementedError
+        yield
+
+    # Tracked members by balance, then archived members, as (member_id,
+    # balance, archived) rows yielded as lists of up to chunk_size rows
+    async def export_balances(self, chunk_size=5000):
+        for fetch, archived in ((self.top_balances, False), (self.archived_members, True)):
+            offset = 0
+            while True:
+                rows = await fetch(chunk_size, offset)
+                if not rows:
+                    break
+                yield [(member_id, balance, archived) for member_id, balance in rows]
+                offset += len(rows)
+
+    # Close out finished months: freeze the final ranking of every month
+    # before `month` and move all but the newest hot_months months out of the
+    # working set. Returns the months moved out.
+    async def rollover(self, hot_months, month=None):
+        raise NotImplementedError
+
+    # Mutations
+    async def add(self, member_id, amount, month=None, actor=None):
+        month = month or current_month()
+        async with self.locks.hold(member_id):
+            await self._restore([member_id], month, actor)
+            record = {
+                "op": "add", "member": member_id, "amount": amount, "month": month,
+                "balance": await self.balance(member_id) + amount,
+                "month_total": await self.month_total(member_id, month) + amount,
+            }
+            await self._commit(record, actor)
+        return record["balance"]
+
+    # Award the same amount to many members as one batch record. Returns the
+    # new balance of every member.
+    async def add_many(self, member_ids, amount, month=None, actor=None):
+        month = month or current_month()
+        member_ids = sorted(set(member_ids))
+        async with self.locks.hold(*member_ids):
+            await self._restore(member_ids, month, actor)
+            records = [
+                {
+                    "op": "add", "member": member_id, "amount": amount, "month": month,
+                    "balance": await self.balance(member_id) + amount,
+                    "month_total": await self.month_total(member_id, month) + amount,
+                }
+                for member_id in member_ids
+            ]
+            if records:
+                await self._commit({"op": "batch", "records": records}, actor)
+        return {record["member"]: record["balance"] for record in records}
+
+    async def remove(self, member_id, amount, actor=None):
+        async with self.locks.hold(member_id):
+            await self._restore([member_id], current_month(), actor)
+            balance = await self.balance(member_id)
+            if balance < amount:
+                raise InsufficientDKP(balance)
+            record = {"op": "remove", "member": member_id, "amount": amount, "balance": balance - amount}
+            await self._commit(record, actor)
+        return record["balance"]
+
+    async def cancel(self, member_id, amount, month=None, actor=None):
+        month = month or current_month()
+        async with self.locks.hold(member_id):
+            await self._restore([member_id], month, actor)
+            balance = await self.balance(member_id)
+            if balance < amount:
+                raise InsufficientDKP(balance)
+            record = {
+                "op": "cancel", "member": member_id, "amount": amount, "month": month,
+                "balance": balance - amount,
+                "month_total": await self.month_total(member_id, month) - amount,
+            }
+            await self._commit(record, actor)
+        return record["balance"]
+
+    # Only the receiver is restored from the archive: the sender is not
+    # checked for the member role, so a sender who is not tracked has no DKP
+    # to trade
+    async def trade(self, sender_id, receiver_id, amount):
+        async with self.locks.hold(sender_id, receiver_id):
+            await self._restore([receiver_id], current_month(), sender_id)
+            tracked, _ = await self.roster([sender_id])
+            sender_balance = tracked.get(sender_id, 0)
+            if sender_balance < amount:
+                raise InsufficientDKP(sender_balance)
+            await self._commit({
+                "op": "trade", "sender": sender_id, "receiver": receiver_id, "amount": amount,
+                "sender_balance": sender_balance - amount,
+                "receiver_balance": await self.balance(receiver_id) + amount,
+            }, sender_id)
+
+    # Restore any of the members that are still archived. A member who
+    # regains the role stays in the archive until the queued role change is
+    # applied, or the reconcile after a restart reaches them, so a change made
+    # to them meanwhile has to start from the archived balance rather than a
+    # fresh one. Callers hold the members' locks.
+    async def _restore(self, member_ids, month, actor=None):
+        _, archived = await self.roster(member_ids)
+        if archived:
+            records = [
+                {"op": "track", "member": member_id, "month": month, "balance": balance}
+                for member_id, balance in sorted(archived.items())
+            ]
+            await self._commit({"op": "batch", "records": records}, actor)
+
+    # Track the members who joined and archive the ones who left, as one batch
+    # record. Members already in that state are skipped. Returns the number
+    # of members restored from the archive, newly added and archived.
+    async def update_roster(self, joined, left, month=None, actor=None):
+        month = month or current_month()
+        joined = set(joined)
+        left = set(left) - joined
+
+        async with self.locks.hold(*(joined | left)):
+            tracked, archived = await self.roster(joined | left)
+            joined = sorted(joined - tracked.keys())
+            left = sorted(left & tracked.keys())
+            records = [
+                {"op": "track", "member": member_id, "month": month, "balance": archived.get(member_id, 0)}
+                for member_id in joined
+            ]
+            records += [{"op": "archive", "member": member_id, "balance": tracked[member_id]} for member_id in left]
+            if records:
+                await self._commit({"op": "batch", "records": records}, actor)
+
+        restored = sum(1 for member_id in joined if member_id in archived)
+        return restored, len(joined) - restored, len(left)
+
+    # Bring the tracked members in line with the current role holders in one
+    # batch: restore or start tracking holders, archive everyone else.
+    # Returns the number of restored, added and archived members.
+    async def reconcile(self, member_ids, month=None):
+        member_ids = set(member_ids)
+        tracked, _ = await self.roster()
+        return await self.update_roster(member_ids - tracked.keys(), tracked.keys() - member_ids, month)
+
+    # Decay every tracked balance in one vectorized pass, committed as one
+    # record tagged with period. A dry run only computes the result. Returns
+    # (member_id, old balance, new balance) for every member that changes.
+    async def decay(self, percent, floor, period, dry_run=False):
+        if dry_run:
+            return await self._decay(percent, floor, period, dry_run)
+        async with self.locks.hold_all():
+            return await self._decay(percent, floor, period, dry_run)
+
+    async def _decay(self, percent, floor, period, dry_run):
+        tracked, _ = await self.roster()
+        member_ids = list(tracked)
+        balances = np.fromiter(tracked.values(), dtype=np.int64, count=len(tracked))
+        decayed = decay_balances(balances, percent, floor)
+        changed = np.flatnonzero(decayed != balances)
+        members = [member_ids[idx] for idx in changed]
+        old_balances = balances[changed].tolist()
+        new_balances = decayed[changed].tolist()
+        if not dry_run:
+            await self._commit({
+                "op": "decay", "period": period, "percent": percent, "floor": floor,
+                "members": members, "balances": new_balances,
+                "amounts": (decayed[changed] - balances[changed]).tolist(),
+            })
+        return list(zip(members, old_balances, new_balances))
+
+    async def alliance_add(self, clan, event_type, amount, actor=None):
+        async with self.locks.hold(f"alliance:{clan}:{event_type}"):
+            record = {
+                "op": "alliance_add", "clan": clan, "event": event_type, "amount": amount,
+                "points": await self.alliance_points(clan, event_type) + amount,
+            }
+            await self._commit(record, actor)
+        return record["points"]
+
+    # Award the same amount for one event to many clans as one batch record.
+    # Returns the new points of every clan.
+    async def alliance_add_many(self, clans, event_type, amount, actor=None):
+        clans = sorted(set(clans))
+        async with self.locks.hold(*(f"alliance:{clan}:{event_type}" for clan in clans)):
+            records = [
+                {
+                    "op": "alliance_add", "clan": clan, "event": event_type, "amount": amount,
+                    "points": await self.alliance_points(clan, event_type) + amount,
+                }
+                for clan in clans
+            ]
+            if records:
+                await self._commit({"op": "batch", "records": records}, actor)
+        return {record["clan"]: record["points"] for record in records}
+
+    async def alliance_remove(self, clan, event_type, amount, actor=None):
+        async with self.locks.hold(f"alliance:{clan}:{event_type}"):
+            points = await self.alliance_points(clan, event_type)
+            if points < amount:
+                raise InsufficientDKP(points)
+            record = {
+                "op": "alliance_remove", "clan": clan, "event": event_type, "amount": amount,
+                "points": points - amount,
+            }
+            await self._commit(record, actor)
+        return record["points"]
+
+
+# Final rankings of closed months, one file per month in directory, as
+# {member_id: points} in rank order. Files are only read when a command asks
+# for an old month; the most recently used boards stay in memory.
+class MonthHistory:
+    def __init__(self, directory, data_format=dataformat.JSON, cache_size=6):
+        self.directory = directory
+        self.data_format = data_format
+        self.cache_size = cache_size
+        self.months = set()
+        self.boards = OrderedDict()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.months = {file[:-len(".json")] for file in os.listdir(self.directory) if file.endswith(".json")}
+
+    def __contains__(self, month):
+        return month in self.months
+
+    # Named .json whatever the data format, like the snapshot files; the
+    # format is detected when a file is read
+    def _file(self, month):
+        return os.path.join(self.directory, f"{month}.json")
+
+    # save() and read() run on the writer thread
+    def save(self, rankings):
+        for month, ranking in rankings.items():
+            save_data(self._file(month), ranking, self.data_format)
+
+    # A month's frozen {member_id: points}
+    def ranking(self, month):
+        return load_data(self._file(month))[0]
+
+    def read(self, month):
+        return RankedIndex(self.ranking(month).items())
+
+    def cached(self, month):
+        board = self.boards.get(month)
+        if board is not None:
+            self.boards.move_to_end(month)
+        return board
+
+    def remember(self, month, board):
+        self.months.add(month)
+        self.boards[month] = board
+        self.boards.move_to_end(month)
+        while len(self.boards) > self.cache_size:
+            self.boards.popitem(last=False)
+
+
+# Resident copy of the DKP JSON files. Every mutation is appended to a ledger
+# as one record holding the resulting values, so replaying the ledger on top
+# of the snapshot files is idempotent. Once the ledger grows past
+# compact_threshold records the snapshots are rewritten and the ledger reset.
+# Balances and each month's earnings are mirrored in ranked indexes that are
+# updated along with every record, so leaderboards never sort the roster.
+# Multi-month boards are answered from a member x month earnings matrix.
+# Snapshot files are read in whatever format they hold and rewritten in
+# data_format, so switching formats converts them on the next start. Months
+# that have rolled over live in a MonthHistory and are loaded on demand, so
+# the resident earnings only cover the hot months.
+class JsonStore(DKPStore):
+    def __init__(self, files, ledger_file, compact_threshold=1000, data_format=dataformat.JSON, history_dir="leaderboard_history",
+                 transactions_file="dkp_history.jsonl"):
+        super().__init__()
+        if data_format not in dataformat.FORMATS:
+            raise ValueError(f"Unknown data format '{data_format}'. Use one of: {', '.join(dataformat.FORMATS)}.")
+        self.files = files
+        self.ledger_file = ledger_file
+        self.compact_threshold = compact_threshold
+        self.data_format = data_format
+        self.data = {}
+        self.dirty = set()
+        self.ledger = None
+        self.ledger_records = 0
+        self.balance_index = RankedIndex()
+        self.month_indexes = {}
+        self.earnings = EarningsMatrix()
+        self.alliance = AllianceMatrix()
+        self.history = MonthHistory(history_dir, data_format)
+        self.range_board = None
+        self.transactions = TransactionLog(transactions_file)
+
+    def load(self):
+        self.history.load()
+        self.transactions.load()
+        self.clock = self.transactions.last_ts
+        self.dirty.clear()
+        for name, file in self.files.items():
+            if not os.path.exists(file):
+                save_data(file, {}, self.data_format)
+            self.data[name], data_format = load_data(file)
+            if data_format != self.data_format:
+                logger.info(f"Converting {file} from {data_format} to {self.data_format} format.")
+                self.dirty.add(name)
+        self._build_indexes()
+
+        replayed, size = self._replay_ledger()
+        self.ledger = open(self.ledger_file, "a")
+        # Cut a torn record off, so new records start on a line of their own
+        self.ledger.truncate(size)
+        if replayed or self.dirty:
+            # Fold the recovered tail and any format conversion into fresh
+            # snapshots before accepting new writes
+            self._write_snapshot(self._snapshot())
+        logger.info(f"Loaded DKP data: {len(self.data[DKP])} members, {len(self.data[ARCHIVE])} archived, {replayed} ledger record(s) replayed.")
+
+    # Apply the ledger records up to the first unreadable one. Returns the
+    # number of records replayed and the byte offset just past the last of
+    # them.
+    def _replay_ledger(self):
+        if not os.path.exists(self.ledger_file):
+            return 0, 0
+
+        replayed = 0
+        size = 0
+        with open(self.ledger_file, "rb") as f:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    # A crash mid-write can only tear the last record, which
+                    # is then cut off by load()
+                    if record is None or not line.endswith(b"\n"):
+                        logger.warning(f"Ignoring unreadable ledger record at line {line_number}.")
+                        break
+                    self._apply(record)
+                    replayed += 1
+                size += len(line)
+        return replayed, size
+
+    @property
+    def dkp_data(self):
+        return self.data[DKP]
+
+    @property
+    def leaderboard_data(self):
+        return self.data[LEADERBOARD]
+
+    @property
+    def archive_data(self):
+        return self.data[ARCHIVE]
+
+    @property
+    def alliance_data(self):
+        return self.data[ALLIANCE]
+
+    @property
+    def meta_data(self):
+        return self.data[META]
+
+    def _build_indexes(self):
+        self.balance_index = RankedIndex(self.dkp_data.items())
+        by_month = {}
+        for member_id, months in self.leaderboard_data.items():
+            for month, points in months.items():
+                by_month.setdefault(month, []).append((member_id, points))
+        self.month_indexes = {month: RankedIndex(items) for month, items in by_month.items()}
+        self.earnings = EarningsMatrix(self.leaderboard_data)
+        self.alliance = AllianceMatrix(self.alliance_data)
+
+    def _set_balance(self, member_id, balance):
+        self.dkp_data[member_id] = balance
+        self.balance_index.set(member_id, balance)
+        self.dirty.add(DKP)
+
+    def _set_balances(self, items):
+        items = list(items)
+        self.dkp_data.update(items)
+        self.balance_index.update(items)
+        self.dirty.add(DKP)
+
+    def _set_month_total(self, member_id, month, points):
+        months = self.leaderboard_data.get(member_id)
+        self.leaderboard_data[member_id] = {**months, month: points} if months else {month: points}
+        self.month_indexes.setdefault(month, RankedIndex()).set(member_id, points)
+        self.earnings.set(member_id, month, points)
+        self.dirty.add(LEADERBOARD)
+
+    # Apply a ledger record to the in-memory state. The per-member and
+    # per-clan dicts nested in the data are replaced, never changed in place,
+    # so a snapshot only needs to copy the top-level dicts.
+    def _apply(self, record):
+        op = record["op"]
+        if op == "batch":
+            for item in record["records"]:
+                self._apply(item)
+        elif op in ("add", "remove", "cancel", "track"):
+            member_id = record["member"]
+            self._set_balance(member_id, record["balance"])
+            if op == "track":
+                if self.archive_data.pop(member_id, None) is not None:
+                    self.dirty.add(ARCHIVE)
+                month = record["month"]
+                self._set_month_total(member_id, month, self._month_total(member_id, month))
+            elif "month" in record:
+                self._set_month_total(member_id, record["month"], record["month_total"])
+        elif op == "trade":
+            self._set_balance(record["sender"], record["sender_balance"])
+            self._set_balance(record["receiver"], record["receiver_balance"])
+        elif op == "archive":
+            member_id = record["member"]
+            self.dkp_data.pop(member_id, None)
+            self.balance_index.discard(member_id)
+            for month in self.leaderboard_data.pop(member_id, {}):
+                self.month_indexes[month].discard(member_id)
+            self.earnings.discard(member_id)
+            self.archive_data[member_id] = record["balance"]
+            self.dirty.update((DKP, LEADERBOARD, ARCHIVE))
+        elif op in ("alliance_add", "alliance_remove"):
+            self.alliance_data[record["clan"]] = {**self.alliance_data.get(record["clan"], {}), record["event"]: record["points"]}
+            self.alliance.set(record["clan"], record["event"], record["points"])
+            self.dirty.add(ALLIANCE)
+        elif op == "decay":
+            self._set_balances(zip(record["members"], record["balances"]))
+            self.meta_data["last_decay"] = record["period"]
+            self.dirty.add(META)
+        elif op == "rollover":
+            expired = set(record["months"])
+            members = set()
+            for month in expired:
+                members.update(self.month_indexes.pop(month, RankedIndex()).points)
+            for member_id in members:
+                months = self.leaderboard_data[member_id]
+                self.leaderboard_data[member_id] = {month: points for month, points in months.items() if month not in expired}
+            self.earnings.drop_through(max(record["months"]))
+            self.dirty.add(LEADERBOARD)
+        else:
+            raise ValueError(f"Unknown ledger operation: {op}")
+
+    async def _persist(self, record):
+        self._apply(record)
+        entries = self.transactions.stage(record_entries(record))
+        self._submit(self._append, json.dumps(record, separators=(",", ":")) + "\n", entries)
+        self.ledger_records += 1
+        self.version += 1
+
+    def _append(self, line, entries):
+        self.ledger.write(line)
+        self.ledger.flush()
+        metrics.inc("dkp_file_written_bytes_total", len(line), file=os.path.normpath(self.ledger_file))
+        if entries:
+            self.transactions.write(entries)
+
+    def _sync(self):
+        os.fsync(self.ledger.fileno())
+        self.transactions.sync()
+
+    async def flush(self):
+        if self.ledger is None:
+            return
+        await self._run(self._sync)
+        if self.ledger_records >= self.compact_threshold:
+            await self.compact()
+
+    # Rewrite the snapshot files and start an empty ledger. The snapshot is
+    # taken on the event loop, so records committed afterwards are queued
+    # behind the rewrite and land in the fresh ledger. Since _apply replaces
+    # nested dicts instead of changing them, shallow copies of the dirty
+    # files are a consistent snapshot, and serializing them on the writer
+    # thread keeps the event loop's share of a compaction to a few
+    # milliseconds however large the files are.
+    async def compact(self):
+        snapshot = self._snapshot()
+        await self._run(self._write_snapshot, snapshot)
+
+    def _snapshot(self):
+        snapshot = {name: dict(self.data[name]) for name in self.dirty}
+        logger.debug(f"Compacting {self.ledger_records} ledger record(s) into {len(snapshot)} snapshot file(s).")
+        self.dirty.clear()
+        self.ledger_records = 0
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        for name in sorted(snapshot):
+            save_data(self.files[name], snapshot[name], self.data_format)
+        self.ledger.seek(0)
+        self.ledger.truncate()
+        os.fsync(self.ledger.fileno())
+
+    def close(self):
+        if self.ledger is None:
+            return
+        super().close()
+        self._write_snapshot(self._snapshot())
+        self.ledger.close()
+        self.ledger = None
+        self.transactions.close()
+
+    def _month_total(self, member_id, month):
+        return self.leaderboard_data.get(member_id, {}).get(month, 0)
+
+    # A month's board from the hot indexes, or from the history once it has
+    # rolled over
+    async def _month_board(self, month):
+        board = self.month_indexes.get(month)
+        if board is not None or month not in self.history:
+            return board or RankedIndex()
+        board = self.history.cached(month)
+        if board is None:
+            board = await self._run(self.history.read, month)
+            self.history.remember(month, board)
+        return board
+
+    # Ranges reaching into rolled-over months combine the hot earnings with
+    # the history boards. The combined board is kept until the next change.
+    async def _range_board(self, first, last):
+        cold = sorted(month for month in self.history.months if first <= month <= last and month not in self.month_indexes)
+        if not cold:
+            return None
+        key = (first, last, self.version)
+        if self.range_board is not None and self.range_board[0] == key:
+            return self.range_board[1]
+
+        totals = dict(self.earnings.top(first, last))
+        for month in cold:
+            for member_id, points in (await self._month_board(month)).points.items():
+                totals[member_id] = totals.get(member_id, 0) + points
+        board = RankedIndex(totals.items())
+        if self.version == key[2]:
+            self.range_board = (key, board)
+        return board
+
+    # Reads
+    async def balance(self, member_id):
+        return self.dkp_data.get(member_id, 0)
+
+    async def month_total(self, member_id, month):
+        if month in self.month_indexes or month not in self.history:
+            return self._month_total(member_id, month)
+        return (await self._month_board(month)).get(member_id, 0)
+
+    async def alliance_points(self, clan, event_type):
+        return self.alliance.get(clan, event_type)
+
+    async def alliance_board(self):
+        return self.alliance
+
+    async def archived_balance(self, member_id):
+        return self.archive_data.get(member_id)
+
+    async def top_balances(self, limit=None, offset=0):
+        return self.balance_index.top(limit, offset)
+
+    async def top_month(self, month, limit=None, offset=0):
+        return (await self._month_board(month)).top(limit, offset)
+
+    async def rank(self, member_id, month=None):
+        index = self.balance_index if month is None else await self._month_board(month)
+        if member_id not in index:
+            return None
+        return index.rank(member_id), index.get(member_id), len(index)
+
+    async def top_range(self, first, last, limit=None, offset=0):
+        if first == last:
+            return await self.top_month(first, limit, offset)
+        board = await self._range_board(first, last)
+        if board is not None:
+            return board.top(limit, offset)
+        return self.earnings.top(first, last, limit, offset)
+
+    async def range_size(self, first, last):
+        if first == last:
+            return await self.board_size(first)
+        board = await self._range_board(first, last)
+        if board is not None:
+            return len(board)
+        return self.earnings.size(first, last)
+
+    async def range_rank(self, member_id, first, last):
+        if first == last:
+            return await self.rank(member_id, first)
+        board = await self._range_board(first, last)
+        if board is None:
+            return self.earnings.rank(member_id, first, last)
+        if member_id not in board:
+            return None
+        return board.rank(member_id), board.get(member_id), len(board)
+
+    async def archived_members(self, limit=None, offset=0):
+        stop = None if limit is None else offset + limit
+        return list(islice(self.archive_data.items(), offset, stop))
+
+    async def board_size(self, month=None):
+        return len(self.balance_index if month is None else await self._month_board(month))
+
+    async def archive_size(self):
+        return len(self.archive_data)
+
+    async def roster(self, member_ids=None):
+        if member_ids is None:
+            return dict(self.dkp_data), dict(self.archive_data)
+        return (
+            {member_id: self.dkp_data[member_id] for member_id in member_ids if member_id in self.dkp_data},
+            {member_id: self.archive_data[member_id] for member_id in member_ids if member_id in self.archive_data},
+        )
+
+    async def last_decay(self):
+        return self.meta_data.get("last_decay")
+
+    async def member_history(self, member_id, since=None, until=None, limit=None, offset=0):
+        offsets = self.transactions.select(member_id, since, until)
+        stop = None if limit is None else offset + limit
+        return await self._run(self.transactions.read, offsets[offset:stop])
+
+    async def history_size(self, member_id, since=None, until=None):
+        return len(self.transactions.select(member_id, since, until))
+
+    async def export_history(self, since=None, until=None, chunk_size=5000):
+        start, end = self.transactions.span(since, until)
+        while start < end:
+            entries, start = await self._run(self.transactions.read_range, start, end, chunk_size)
+            yield entries
+
+    async def rollover(self, hot_months, month=None):
+        current = month_index(month or current_month())
+        finished = sorted(month for month in self.month_indexes if month_index(month) < current)
+        # Final rankings are frozen once per month; a month is complete when
+        # the next one starts since commands only write the current month
+        rankings = {month: dict(self.month_indexes[month].top()) for month in finished if month not in self.history}
+        if rankings:
+            await self._run(self.history.save, rankings)
+            self.history.months.update(rankings)
+
+        cutoff = month_key(current - max(hot_months, 1) + 1)
+        expired = [month for month in finished if month < cutoff]
+        if expired:
+            # The history files are on disk before the ledger drops the months
+            await self._commit({"op": "rollover", "months": expired})
+        return expired
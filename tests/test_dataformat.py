@@ -0,0 +1,73 @@
+import pytest
+
+import dataformat
+
+
+# Run every compact round-trip with msgpack and with the JSON fallback
+@pytest.fixture(params=["msgpack", "json"])
+def compact(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(dataformat, "msgpack", None)
+    elif dataformat.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    return request.param
+
+
+def round_trip(data):
+    loaded, data_format = dataformat.loads(dataformat.dumps(data, dataformat.COMPACT))
+    assert data_format == dataformat.COMPACT
+    return loaded
+
+
+def test_flat_ids_with_leading_zeros(compact):
+    data = {"123456789012345678": 10, "007": 5, "0": 1, "42": 0}
+    assert round_trip(data) == data
+
+
+def test_flat_non_numeric_ids(compact):
+    data = {"123": 1, "abc": 2, "": 3}
+    assert round_trip(data) == data
+
+
+def test_nested_months(compact):
+    data = {"1": {"2025-11": 5, "2026-01": 7}, "2": {"2026-02": 3}}
+    loaded = round_trip(data)
+    assert loaded == data
+    assert list(loaded["1"]) == ["2025-11", "2026-01"]
+
+
+def test_nested_non_month_keys(compact):
+    data = {
+        "ClanA": {"Siege": 10, "2026-13": 1, "5": 2},
+        "ClanB": {"2026-01": 4},
+    }
+    assert round_trip(data) == data
+
+
+def test_nested_only_non_month_keys(compact):
+    data = {"ClanA": {"Siege": 10}, "ClanB": {"Boss": 3}}
+    assert round_trip(data) == data
+
+
+def test_empty_rows(compact):
+    data = {"1": {}, "007": {"2026-01": 3}, "2": {}}
+    assert round_trip(data) == data
+
+
+def test_all_rows_empty(compact):
+    data = {"1": {}, "2": {}}
+    assert round_trip(data) == data
+
+
+def test_empty_file(compact):
+    assert round_trip({}) == {}
+
+
+def test_mixed_values_stay_raw(compact):
+    data = {"last_decay": "2026-01", "nested": {"a": 1}}
+    assert round_trip(data) == data
+
+
+def test_json_format_is_detected():
+    data = {"1": {"2026-01": 3}}
+    assert dataformat.loads(dataformat.dumps(data)) == (data, dataformat.JSON)
@@ -0,0 +1,126 @@
+import random
+
+from earnings import EarningsMatrix, month_index, month_key
+
+
+# Plain {member_id: {month: points}} model the matrix is checked against
+def expected_top(model, first, last):
+    totals = {}
+    for member_id, months in model.items():
+        in_range = [points for month, points in months.items() if first <= month <= last]
+        if in_range:
+            totals[member_id] = sum(in_range)
+    return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+
+def check(matrix, model, first, last):
+    expected = expected_top(model, first, last)
+    assert matrix.top(first, last) == expected
+    assert matrix.size(first, last) == len(expected)
+    for member_id, points in expected:
+        rank = sum(1 for _, other in expected if other > points) + 1
+        assert matrix.rank(member_id, first, last) == (rank, points, len(expected))
+
+
+def months(first, count):
+    return [month_key(month_index(first) + offset) for offset in range(count)]
+
+
+def test_build_matches_model():
+    model = {"1": {"2026-01": 5, "2026-03": 2}, "2": {"2026-02": 7}, "3": {}}
+    matrix = EarningsMatrix(model)
+    check(matrix, model, "2026-01", "2026-03")
+    check(matrix, model, "2026-02", "2026-02")
+    check(matrix, model, "2025-01", "2025-12")
+    assert matrix.rank("3", "2026-01", "2026-03") is None
+
+
+def test_zero_points_still_listed():
+    matrix = EarningsMatrix()
+    matrix.set("1", "2026-01", 0)
+    assert matrix.top("2026-01", "2026-01") == [("1", 0)]
+
+
+def test_discard_frees_row_for_reuse():
+    model = {"1": {"2026-01": 5}, "2": {"2026-01": 3, "2026-02": 4}}
+    matrix = EarningsMatrix(model)
+    matrix.discard("2")
+    del model["2"]
+    check(matrix, model, "2026-01", "2026-02")
+    assert matrix.rank("2", "2026-01", "2026-02") is None
+
+    # The freed row starts empty for the next member
+    matrix.set("3", "2026-02", 1)
+    model["3"] = {"2026-02": 1}
+    check(matrix, model, "2026-01", "2026-02")
+    check(matrix, model, "2026-01", "2026-01")
+
+
+def test_prepend_earlier_month():
+    model = {"1": {"2026-03": 5}, "2": {"2026-04": 2}}
+    matrix = EarningsMatrix(model)
+    matrix.set("2", "2025-12", 4)
+    model["2"]["2025-12"] = 4
+    assert matrix.first_month == month_index("2025-12")
+    check(matrix, model, "2025-12", "2026-04")
+    check(matrix, model, "2026-01", "2026-03")
+    check(matrix, model, "2025-12", "2025-12")
+
+
+def test_later_month_carries_totals():
+    model = {"1": {"2026-01": 5}}
+    matrix = EarningsMatrix(model)
+    matrix.set("2", "2026-05", 1)
+    model["2"] = {"2026-05": 1}
+    check(matrix, model, "2026-01", "2026-05")
+    check(matrix, model, "2026-02", "2026-04")
+
+
+def test_drop_through():
+    model = {"1": {"2026-01": 5, "2026-02": 1, "2026-03": 2}, "2": {"2026-01": 9}}
+    matrix = EarningsMatrix(model)
+    matrix.drop_through("2026-01")
+    model = {"1": {"2026-02": 1, "2026-03": 2}, "2": {}}
+    check(matrix, model, "2026-01", "2026-03")
+    check(matrix, model, "2026-03", "2026-03")
+
+    # Dropping past the last month leaves no columns
+    matrix.drop_through("2026-06")
+    check(matrix, {}, "2026-01", "2026-12")
+    matrix.set("1", "2026-07", 3)
+    check(matrix, {"1": {"2026-07": 3}}, "2026-01", "2026-12")
+
+
+def test_drop_through_before_first_month_is_a_no_op():
+    model = {"1": {"2026-03": 5}}
+    matrix = EarningsMatrix(model)
+    matrix.drop_through("2026-01")
+    check(matrix, model, "2026-01", "2026-03")
+
+
+def test_random_operations_match_model():
+    rng = random.Random(7)
+    month_keys = months("2025-06", 12)
+    model = {}
+    matrix = EarningsMatrix()
+    for step in range(2000):
+        op = rng.random()
+        member_id = str(rng.randrange(40))
+        if op < 0.8:
+            month = rng.choice(month_keys)
+            points = rng.randrange(0, 50)
+            matrix.set(member_id, month, points)
+            model.setdefault(member_id, {})[month] = points
+        elif op < 0.95:
+            matrix.discard(member_id)
+            model.pop(member_id, None)
+        else:
+            cutoff = rng.choice(month_keys[:4])
+            matrix.drop_through(cutoff)
+            model = {
+                member_id: {month: points for month, points in row.items() if month > cutoff}
+                for member_id, row in model.items()
+            }
+        if step % 100 == 0:
+            first, last = sorted(rng.sample(month_keys, 2))
+            check(matrix, model, first, last)
+    check(matrix, model, month_keys[0], month_keys[-1])
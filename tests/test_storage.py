@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from storage import JsonStore, InsufficientDKP, DKP, LEADERBOARD, ARCHIVE, ALLIANCE, META
+
+
+@pytest.fixture
+def open_store(tmp_path):
+    def open_store():
+        store = JsonStore(
+            {name: str(tmp_path / f"{name}.json") for name in (DKP, LEADERBOARD, ARCHIVE, ALLIANCE, META)},
+            str(tmp_path / "ledger.jsonl"),
+            history_dir=str(tmp_path / "history"),
+            transactions_file=str(tmp_path / "history.jsonl"),
+        )
+        store.load()
+        return store
+    return open_store
+
+# Stop a store the way a crash would: the ledger is neither compacted nor
+# closed cleanly
+def crash(store):
+    store.executor.shutdown(wait=True)
+    store.ledger.close()
+    store.transactions.close()
+
+def balances(store):
+    return dict(asyncio.run(store.top_balances()))
+
+
+def test_ledger_is_replayed_after_a_crash(open_store):
+    store = open_store()
+
+    async def commands():
+        await store.add("1", 10, "2025-01")
+        await store.add("2", 20, "2025-01")
+        await store.flush()
+    asyncio.run(commands())
+    crash(store)
+
+    store = open_store()
+    assert balances(store) == {"1": 10, "2": 20}
+    store.close()
+
+
+def test_torn_record_is_cut_off_before_new_records(open_store):
+    store = open_store()
+    crash(store)
+    with open(store.ledger_file, "a") as f:
+        f.write('{"op":"add","mem')
+
+    store = open_store()
+
+    async def commands():
+        await store.add("1", 10, "2025-01")
+        await store.add("2", 20, "2025-01")
+        await store.flush()
+    asyncio.run(commands())
+    crash(store)
+
+    # Crashing again before a compaction still recovers every record
+    store = open_store()
+    assert balances(store) == {"1": 10, "2": 20}
+    store.close()
+
+
+def test_unterminated_record_is_cut_off(open_store):
+    store = open_store()
+    crash(store)
+    with open(store.ledger_file, "a") as f:
+        f.write('{"op":"add","member":"1","amount":5,"balance":5}')
+
+    store = open_store()
+    assert balances(store) == {}
+    with open(store.ledger_file) as f:
+        assert f.read() == ""
+    store.close()
+
+
+def test_trade_from_an_archived_member_is_refused(open_store):
+    store = open_store()
+
+    async def commands():
+        await store.add("1", 100, "2025-01")
+        await store.update_roster([], ["1"])
+        with pytest.raises(InsufficientDKP) as raised:
+            await store.trade("1", "2", 50)
+        assert raised.value.balance == 0
+    asyncio.run(commands())
+
+    assert balances(store) == {}
+    assert asyncio.run(store.archived_members()) == [("1", 100)]
+    store.close()
+
+
+def test_trade_restores_an_archived_receiver(open_store):
+    store = open_store()
+
+    async def commands():
+        await store.add("1", 100, "2025-01")
+        await store.add("2", 30, "2025-01")
+        await store.update_roster([], ["2"])
+        await store.trade("1", "2", 50)
+    asyncio.run(commands())
+
+    assert balances(store) == {"1": 50, "2": 80}
+    assert asyncio.run(store.archived_members()) == []
+    store.close()
+
+
+def test_archive_version_follows_archive_changes(open_store):
+    store = open_store()
+
+    async def commands():
+        await store.add("1", 10, "2025-01")
+        version = store.archive_version
+        await store.update_roster([], ["1"])
+        assert store.archive_version > version
+        version = store.archive_version
+        await store.add("2", 10, "2025-01")
+        assert store.archive_version == version
+        # Restored by a DKP change before its role change is applied
+        await store.add("1", 5, "2025-01")
+        assert store.archive_version > version
+    asyncio.run(commands())
+    store.close()
@@ -0,0 +1,125 @@
+import pytest
+
+from transactions import TransactionLog, ADD, REMOVE, record_entries
+
+
+# Entries (ts, actor, member_id, amount, balance, kind) in commit order:
+# member "1" at ts 10, 20, 20 and 30, member "2" at ts 20 and 40
+ENTRIES = [
+    (10, "9", "1", 5, 5, ADD),
+    (20, "9", "1", 3, 8, ADD),
+    (20, "9", "2", 4, 4, ADD),
+    (20, "9", "1", -2, 6, REMOVE),
+    (30, "9", "1", 1, 7, ADD),
+    (40, "9", "2", 1, 5, ADD),
+]
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = TransactionLog(str(tmp_path / "history.jsonl"))
+    log.load()
+    log.write(log.stage(ENTRIES))
+    yield log
+    log.close()
+
+
+def select(log, member_id, since=None, until=None):
+    return log.read(log.select(member_id, since, until))
+
+def span(log, since=None, until=None):
+    start, end = log.span(since, until)
+    entries, next_start = log.read_range(start, end, len(ENTRIES) + 1)
+    assert next_start == end
+    return entries
+
+
+def test_select_is_newest_first_and_inclusive(log):
+    assert select(log, "1") == [ENTRIES[4], ENTRIES[3], ENTRIES[1], ENTRIES[0]]
+    assert select(log, "1", 20, 20) == [ENTRIES[3], ENTRIES[1]]
+    assert select(log, "1", 20) == [ENTRIES[4], ENTRIES[3], ENTRIES[1]]
+    assert select(log, "1", until=20) == [ENTRIES[3], ENTRIES[1], ENTRIES[0]]
+
+
+def test_select_bounds_between_and_outside_entries(log):
+    assert select(log, "1", 11, 29) == [ENTRIES[3], ENTRIES[1]]
+    assert select(log, "1", 31) == []
+    assert select(log, "1", until=9) == []
+    assert select(log, "1", 30, 10) == []
+    assert select(log, "3") == []
+
+
+def test_span_is_inclusive_by_second(log):
+    assert span(log) == ENTRIES
+    assert span(log, 20, 20) == ENTRIES[1:4]
+    assert span(log, 20) == ENTRIES[1:]
+    assert span(log, until=20) == ENTRIES[:4]
+    assert span(log, 15, 35) == ENTRIES[1:5]
+
+
+def test_span_outside_entries_is_empty(log):
+    assert span(log, 41) == []
+    assert span(log, until=9) == []
+    assert span(log, 25, 29) == []
+    start, end = log.span(50)
+    assert start == end == log.size
+
+
+def test_read_range_in_chunks(log):
+    start, end = log.span()
+    chunks = []
+    while start < end:
+        entries, start = log.read_range(start, end, 4)
+        chunks.append(entries)
+    assert chunks == [ENTRIES[:4], ENTRIES[4:]]
+
+
+def test_empty_log(tmp_path):
+    log = TransactionLog(str(tmp_path / "history.jsonl"))
+    log.load()
+    assert log.select("1") == []
+    assert log.span() == (0, 0)
+    assert log.last_ts == 0
+    log.close()
+
+
+def test_reload_rebuilds_indexes_and_cuts_torn_tail(log):
+    log.close()
+    with open(log.file, "ab") as f:
+        f.write(b'[50,"9","1",1')
+    log.load()
+    assert log.last_ts == 40
+    assert select(log, "2", 40) == [ENTRIES[5]]
+    assert span(log, 20, 20) == ENTRIES[1:4]
+
+    # New entries go where the torn line was
+    log.write(log.stage([(50, "9", "1", 1, 8, ADD)]))
+    log.close()
+    log.load()
+    assert select(log, "1", 50) == [(50, "9", "1", 1, 8, ADD)]
+
+
+def test_reload_skips_unreadable_lines(log):
+    log.close()
+    with open(log.file, "rb") as f:
+        lines = f.readlines()
+    lines[1] = b"not json\n"
+    with open(log.file, "wb") as f:
+        f.writelines(lines)
+    log.load()
+    assert select(log, "1", 20, 20) == [ENTRIES[3]]
+    assert list(log.scan()) == ENTRIES[:1] + ENTRIES[2:]
+
+
+def test_record_entries_inherit_batch_time_and_actor():
+    record = {
+        "op": "batch", "ts": 7, "actor": "9", "records": [
+            {"op": "add", "member": "1", "amount": 2, "balance": 2},
+            {"op": "trade", "sender": "1", "receiver": "2", "amount": 1, "sender_balance": 1, "receiver_balance": 1},
+        ],
+    }
+    assert list(record_entries(record)) == [
+        (7, "9", "1", 2, 2, ADD),
+        (7, "9", "1", -1, 1, "trade"),
+        (7, "9", "2", 1, 1, "trade"),
+    ]
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ADD = "add"
+REMOVE = "remove"
+CANCEL = "cancel"
+TRADE = "trade"
+TRACK = "track"
+ARCHIVE = "archive"
+DECAY = "decay"
+
+# Columns of a history entry, in order
+FIELDS = ("ts", "actor", "member_id", "amount", "balance", "kind")
+
+
+# History entries (ts, actor, member_id, amount, balance, kind) for a ledger
+# record: the signed change and resulting balance of every member it touched.
+# Records inside a batch take the batch's time and actor. Alliance records
+# touch no member and have none.
+def record_entries(record, ts=None, actor=None):
+    ts = record.get("ts", ts)
+    actor = record.get("actor", actor)
+    op = record["op"]
+    if op == "batch":
+        for item in record["records"]:
+            yield from record_entries(item, ts, actor)
+    elif op == "add":
+        yield ts, actor, record["member"], record["amount"], record["balance"], ADD
+    elif op in (REMOVE, CANCEL):
+        yield ts, actor, record["member"], -record["amount"], record["balance"], op
+    elif op in (TRACK, ARCHIVE):
+        yield ts, actor, record["member"], 0, record["balance"], op
+    elif op == "trade":
+        yield ts, actor, record["sender"], -record["amount"], record["sender_balance"], TRADE
+        yield ts, actor, record["receiver"], record["amount"], record["receiver_balance"], TRADE
+    elif op == "decay":
+        for member_id, amount, balance in zip(record["members"], record["amounts"], record["balances"]):
+            yield ts, actor, member_id, amount, balance, DECAY
+
+
+def _dumps(entry):
+    if orjson is not None:
+        return orjson.dumps(entry) + b"\n"
+    return json.dumps(entry, separators=(",", ":")).encode() + b"\n"
+
+def _loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+# The entry on a line as a tuple, or None for an unreadable line
+def _parse(line):
+    try:
+        return tuple(_loads(line))
+    except ValueError:
+        return None
+
+
+# Append-only file of history entries, one JSON array per line in commit
+# order, which is never compacted. Two in-memory indexes point into it: the
+# times and offsets of every member's entries, and the offset of the first
+# entry of each second, so a member's history or a time range is found by
+# bisection and read with a few seeks. Offsets are assigned on the event
+# loop when entries are staged; the bytes are written later on the store's
+# writer thread, which also serves the reads, so a read queued after a
+# write always sees it.
+class TransactionLog:
+    def __init__(self, file):
+        self.file = file
+        self.members = {}
+        self.times = array("q")
+        self.offsets = array("q")
+        self.size = 0
+        self.writer = None
+        self.reader = None
+
+    def load(self):
+        self.members = {}
+        self.times = array("q")
+        self.offsets = array("q")
+        self.size = 0
+        if os.path.exists(self.file):
+            with open(self.file, "rb") as f:
+                for line in f:
+                    # A crash mid-write leaves an unterminated last line,
+                    # which is cut off below
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self._index(_loads(line), self.size)
+                    except ValueError:
+                        logger.warning(f"Ignoring unreadable history entry at byte {self.size} of {self.file}.")
+                    self.size += len(line)
+        self.writer = open(self.file, "ab")
+        self.writer.truncate(self.size)
+        self.reader = open(self.file, "rb")
+
+    def close(self):
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = None
+
+    def _index(self, entry, offset):
+        ts, member_id = entry[0], entry[2]
+        if not self.times or self.times[-1] != ts:
+            self.times.append(ts)
+            self.offsets.append(offset)
+        indexed = self.members.get(member_id)
+        if indexed is None:
+            indexed = self.members[member_id] = (array("q"), array("q"))
+        indexed[0].append(ts)
+        indexed[1].append(offset)
+
+    @property
+    def last_ts(self):
+        return self.times[-1] if self.times else 0
+
+    # Index entries and return the bytes to hand to write()
+    def stage(self, entries):
+        lines = []
+        for entry in entries:
+            line = _dumps(entry)
+            self._index(entry, self.size)
+            self.size += len(line)
+            lines.append(line)
+        return b"".join(lines)
+
+    def write(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+        metrics.inc("dkp_file_written_bytes_total", len(data), file=os.path.normpath(self.file))
+
+    def sync(self):
+        os.fsync(self.writer.fileno())
+
+    # Offsets of a member's entries between since and until, newest first
+    def select(self, member_id, since=None, until=None):
+        indexed = self.members.get(member_id)
+        if indexed is None:
+            return []
+        times, offsets = indexed
+        low = 0 if since is None else bisect_left(times, since)
+        high = len(times) if until is None else bisect_right(times, until)
+        return offsets[low:high][::-1]
+
+    # Byte range of the entries between since and until
+    def span(self, since=None, until=None):
+        low = 0 if since is None else bisect_left(self.times, since)
+        high = len(self.times) if until is None else bisect_right(self.times, until)
+        start = self.offsets[low] if low < len(self.offsets) else self.size
+        end = self.offsets[high] if high < len(self.offsets) else self.size
+        return start, end
+
+    def read(self, offsets):
+        entries = []
+        for offset in offsets:
+            self.reader.seek(offset)
+            entries.append(tuple(_loads(self.reader.readline())))
+        return entries
+
+    # Every entry in file order
+    def scan(self):
+        with open(self.file, "rb") as f:
+            offset = 0
+            for line in f:
+                if offset >= self.size:
+                    break
+                offset += len(line)
+                entry = _parse(line)
+                if entry is not None:
+                    yield entry
+
+    # Up to count entries from start, stopping at end. Returns (entries, next offset).
+    def read_range(self, start, end, count):
+        self.reader.seek(start)
+        entries = []
+        while start < end and len(entries) < count:
+            line = self.reader.readline()
+            start += len(line)
+            entry = _parse(line)
+            if entry is not None:
+                entries.append(entry)
+        return entries, start